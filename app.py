@@ -1,11 +1,27 @@
-from flask import Flask, render_template, request, jsonify, Response, send_from_directory, redirect, make_response, url_for as flask_url_for, g
+from flask import Flask, render_template, request, jsonify, Response, send_from_directory, send_file, redirect, make_response, url_for as flask_url_for, g
+from flask import before_render_template, template_rendered, abort
 from flask_babel import Babel, get_locale
-from functions.database import new_subscriber, new_message, get_posts_paginated, get_post_by_slug, get_all_posts, get_random_posts, add_new_post, create_slug
-from datetime import datetime, timezone
-import re, os
+from functions.database import init_db, add_new_post, create_slug, rebuild_search_index
+from functions.database import on_posts_changed
+from functions.post_store import get_snapshot, get_posts_paginated, get_post_by_slug, get_random_posts, get_last_published, post_created_at
+from functions.page_cache import PageCache, CachedPage, deploy_id, make_etag
+from functions.cache_backend import get_cache
+from functions.image_jobs import enqueue as enqueue_image_job, get_job as get_image_job, start_workers as start_image_workers
+from functions.image_resizer import ALLOWED_WIDTHS, choose_format, get_resized, output_formats
+from functions.search import search as search_posts
+from functions.related_posts import get_related_posts, rebuild_related_posts, related_posts_missing
+from functions.sitemap import INDEX_NAME as SITEMAP_INDEX_NAME, PAGES_NAME as SITEMAP_PAGES_NAME, build_all as build_sitemap, update_for_post as update_sitemap_for_post, is_sitemap_name
+from functions.turnstile import get_verifier as get_turnstile_verifier, PASSED as TURNSTILE_PASSED, UNAVAILABLE as TURNSTILE_UNAVAILABLE
+from functions.write_queue import queue_message, queue_subscriber, replay_spool
+from functions.subscribers import add_subscriber, forget_subscriber, normalize_email
+from functions import metrics, profiling, site_config
+from functions.site_config import sitemap_args
+from functions.compression import ENCODINGS, ENCODING_SUFFIXES, negotiate_encoding, compress, is_compressible
+from datetime import datetime
+import re, os, mimetypes, json, hmac, time
 from markupsafe import escape
 from functools import wraps
-from urllib.parse import quote
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 from PIL import Image
 from werkzeug.utils import secure_filename
@@ -14,14 +30,37 @@ load_dotenv()
 
 
 app = Flask(__name__)
-app.config['BABEL_DEFAULT_LOCALE'] = 'ar'
-app.config['BABEL_SUPPORTED_LOCALES'] = ['en', 'ar']
+app.config['BABEL_DEFAULT_LOCALE'] = site_config.DEFAULT_LANGUAGE
+app.config['BABEL_SUPPORTED_LOCALES'] = site_config.LANGUAGES
 app.config['BABEL_TRANSLATION_DIRECTORIES'] = 'translations'
-app.config['SITEMAP_BASE_URL'] = 'https://www.iiot-bay.com'
-app.config['SITEMAP_CACHE_TIMEOUT'] = 86400  # 24 hours
+app.config['SITEMAP_BASE_URL'] = site_config.SITE_URL
+app.config['PAGE_CACHE_ENABLED'] = os.getenv('PAGE_CACHE_ENABLED', '1') != '0'
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024  # rendered + compressed bodies
+app.config['PAGE_CACHE_RANDOM_TTL'] = 60  # pages with random post carousels
+app.config['PAGE_CACHE_STATIC_TTL'] = 3600  # about/services/terms, which no publish invalidates
+# Same window as the page cache TTL so every worker shows the same random posts
+app.config['RANDOM_POSTS_BUCKET_SECONDS'] = app.config['PAGE_CACHE_RANDOM_TTL']
+# Sitemap index and shards with their .gz/.br variants (see functions/sitemap.py)
+app.config['BUILD_DIR'] = site_config.BUILD_DIR
+# Content-hashed copies of static files written by build_assets.py
+app.config['ASSET_MANIFEST'] = os.path.join(app.static_folder, 'dist', 'manifest.json')
+app.config['IMMUTABLE_MAX_AGE'] = 31536000  # 1 year for fingerprinted assets
+app.config['RESIZED_IMAGE_MAX_AGE'] = 86400  # /img/<width>/<name>, revalidated daily
+app.config['SEARCH_MAX_AGE'] = 60  # /api/search responses
 
 babel = Babel(app)
 
+# Add any columns newer code expects to an existing database
+init_db()
+# Index posts that predate the search index (or were added by hand)
+rebuild_search_index(only_if_stale=True)
+if related_posts_missing():
+    rebuild_related_posts()
+# Contact messages/signups a crashed worker had acknowledged but not written yet
+replay_spool()
+# Threads that turn uploaded post images into WebP/AVIF derivatives and publish the post
+start_image_workers()
+
 
 def get_locale():
     # 1. Check URL for language (from view_args set by @with_lang decorator)
@@ -45,6 +84,98 @@ def get_locale():
 babel.init_app(app, locale_selector=get_locale)
 
 
+# ============================================================================
+# METRICS - per-endpoint latency, status and size, plus template render times
+# ============================================================================
+# Registered before every other hook: the timer starts first and the
+# after_request handler runs last, so it sees the final (compressed) size.
+# SQL timings are recorded by functions/database.py; see functions/metrics.py
+# ============================================================================
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        labels = {'endpoint': request.endpoint or 'unmatched', 'method': request.method}
+        metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - started)
+        metrics.inc('http_requests_total', {**labels, 'status': str(response.status_code)})
+        size = response.calculate_content_length()
+        if size is not None:
+            metrics.observe('http_response_size_bytes', labels, size)
+    return response
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def record_render_time(sender, template, context, **extra):
+    started = g.get('render_started')
+    if started:
+        metrics.observe('template_render_duration_seconds', {'template': template.name or ''},
+                        time.perf_counter() - started.pop())
+
+
+def key_matches(provided, env_name):
+    """Whether provided is the key in env_name (falling back to the admin key)"""
+    expected = os.getenv(env_name) or os.getenv('admin_add_new_post_key')
+    return bool(expected and provided) and hmac.compare_digest(provided.encode(), expected.encode())
+
+
+def request_key():
+    """Key sent as a Bearer token or ?key="""
+    auth = request.headers.get('Authorization', '')
+    return auth[7:] if auth.startswith('Bearer ') else request.args.get('key', '')
+
+
+# ============================================================================
+# PROFILING - opt-in cProfile/stack sampling of live requests
+# ============================================================================
+# 1 in PROFILE_SAMPLE_RATE requests, or any request sent with
+# "X-Profile: <PROFILE_KEY>". Registered right after the metrics hooks, so
+# the profile covers every other hook too. See functions/profiling.py
+# ============================================================================
+
+@app.before_request
+def start_request_profile():
+    forced = profiling.PROFILE_HEADER in request.headers
+    if forced and not key_matches(request.headers[profiling.PROFILE_HEADER], 'PROFILE_KEY'):
+        forced = False
+    profiler = profiling.start_profiler(forced)
+    if profiler:
+        g.profiler = profiler
+        g.profile_forced = forced
+
+
+@app.after_request
+def save_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler:
+        try:
+            name = profiling.save_profile(profiler, request.endpoint or 'unmatched')
+        except OSError as e:
+            print(f"Saving profile failed: {e}")
+        else:
+            if g.get('profile_forced'):
+                response.headers['X-Profile-File'] = name
+    return response
+
+
+@app.teardown_request
+def stop_request_profile(exc):
+    # after_request doesn't run when a response couldn't be built at all
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.stop()
+
+
 # ============================================================================
 # CANONICAL URL ENFORCEMENT - SEO CRITICAL
 # ============================================================================
@@ -69,9 +200,11 @@ def enforce_canonical_url():
     # 3. Admin endpoints (may need flexibility)
     # 4. Sitemap/robots (should work on any domain)
     if (request.path.startswith('/static/') or 
+        request.path.startswith('/img/') or 
         request.path.startswith('/api/') or 
         request.path.startswith('/admin/') or
-        request.path in ['/sitemap.xml', '/robots.txt', '/favicon.ico']):
+        request.path.startswith('/sitemap') or
+        request.path in ['/robots.txt', '/favicon.ico']):
         return None
     
     # Get the current URL components
@@ -126,16 +259,141 @@ def with_lang(f):
         # Call the wrapped function
         response = make_response(f(*args, **kwargs))
         
-        # Set cookie to persist language choice (for post pages)
-        response.set_cookie('user_lang', lang, max_age=60*60*24*365)
+        # Set cookie to persist language choice (for post pages), only when it
+        # changes so the common response stays free of Set-Cookie and cacheable
+        if request.cookies.get('user_lang') != lang:
+            response.set_cookie('user_lang', lang, max_age=60*60*24*365)
         
         return response
     return decorated_function
 
 
+# ============================================================================
+# RENDERED PAGE CACHE
+# ============================================================================
+# Pages are rendered and compressed once, then replayed from memory until a new
+# post is published (or their TTL runs out for pages with random content).
+# The shared cache backend lets one worker's render serve all the others;
+# its keys include a deploy id, so a restart with new templates, translations,
+# code or assets starts from an empty shared page cache.
+# ============================================================================
+
+page_cache = PageCache(max_bytes=app.config['PAGE_CACHE_MAX_BYTES'], shared=get_cache(),
+                       namespace=deploy_id(app.config['ASSET_MANIFEST'],
+                                           os.path.join(app.root_path, app.template_folder),
+                                           os.path.join(app.root_path, app.config['BABEL_TRANSLATION_DIRECTORIES']),
+                                           os.path.join(app.root_path, 'app.py'),
+                                           os.path.join(app.root_path, 'functions')))
+
+
+def conditional_response(response, etag, last_modified=None, variants=None):
+    """
+    Attach validators, answer If-None-Match / If-Modified-Since with a 304 and
+    otherwise send the best encoding the client accepts. variants holds
+    precompressed bodies by encoding; without it the body is compressed here.
+    """
+    encoding = None
+    if variants or is_compressible(response):
+        encoding = negotiate_encoding(request.accept_encodings, tuple(variants) if variants else ENCODINGS)
+        response.vary.add('Accept-Encoding')
+
+    # Strong ETags must differ between encodings of the same page
+    response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Caches may store the page but must revalidate, which the validators make cheap
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response = response.make_conditional(request)
+
+    # Only pay for compression when the body is actually sent
+    if encoding and response.status_code == 200:
+        response.set_data(variants[encoding] if variants else compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _page_response(response, etag, last_modified=None, variants=None):
+    if not getattr(g, 'lang', None):
+        # Language came from the cookie or Accept-Language, not the URL
+        response.vary.update(('Cookie', 'Accept-Language'))
+    return conditional_response(response, etag, last_modified, variants)
+
+
+def _cached_page_response(entry):
+    response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+    return _page_response(response, entry.etag, entry.last_modified, entry.variants)
+
+
+def cached_page(ttl=None, tags=(), depends_on_posts=True, last_modified=None, query_args=()):
+    """
+    Cache successful GET responses of a view, keyed by endpoint, language, path
+    and the query_args the view reads. Other query parameters are ignored, so
+    arbitrary ?x=N URLs can't fill the cache with copies of the same page.
+
+    Pages that render posts are tied to the post snapshot version, so they are
+    re-rendered as soon as this worker sees a newly published post.
+    last_modified is an optional callable taking the view's arguments and
+    returning the datetime sent as Last-Modified. With PAGE_CACHE_ENABLED off
+    pages are rendered every time but still carry ETag/Last-Modified.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return f(*args, **kwargs)
+            if not app.config['PAGE_CACHE_ENABLED']:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                version = get_snapshot().version if depends_on_posts else None
+                return _page_response(response, make_etag(response.get_data(), version),
+                                      last_modified(**kwargs) if last_modified else None)
+
+            key = f"{request.endpoint}|{get_locale()}|{request.path}"
+            if query_args:
+                key += '?' + urlencode([(name, request.args.get(name, '')) for name in query_args])
+            version = get_snapshot().version if depends_on_posts else None
+            entry = page_cache.get(key, version)
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                # Only plain successful pages are shared (no 404s, redirects or streams)
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry_tags = {request.endpoint, *tags}
+                if 'post_slug' in kwargs:
+                    entry_tags.add(f"post:{kwargs['post_slug']}")
+                entry = CachedPage(response.get_data(), response.status_code, response.mimetype,
+                                   ttl=ttl, tags=entry_tags, version=version,
+                                   last_modified=last_modified(**kwargs) if last_modified else None)
+                page_cache.set(key, entry)
+            return _cached_page_response(entry)
+        return decorated_function
+    return decorator
+
+
+def _load_asset_manifest():
+    """Original static path -> fingerprinted path, empty until build_assets.py has run"""
+    try:
+        with open(app.config['ASSET_MANIFEST'], encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Loaded once at startup; rerun build_assets.py and restart to pick up changes
+_asset_manifest = _load_asset_manifest()
+
+
 # Custom url_for that automatically includes lang parameter
 def url_for(endpoint, **values):
     """Custom url_for that automatically includes the current language"""
+    # Static files resolve to their fingerprinted copy when one was built
+    if endpoint == 'static' and values.get('filename') in _asset_manifest:
+        values['filename'] = _asset_manifest[values['filename']]
+        # The hash in the name already busts caches
+        values.pop('v', None)
+
     # Don't add lang for static files, external URLs, or post endpoints
     if endpoint == 'static' or endpoint.startswith('_') or endpoint == 'post':
         return flask_url_for(endpoint, **values)
@@ -203,6 +461,91 @@ def set_security_headers(response):
     return response
 
 
+@app.after_request
+def compress_response(response):
+    """Compress responses that weren't already served from a precompressed variant"""
+    if not is_compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f"{etag}-{encoding}")
+    return response
+
+
+# ============================================================================
+# PRECOMPRESSED STATIC FILES
+# ============================================================================
+# build_assets.py writes .br/.gz next to CSS/JS files; serve those directly
+# instead of compressing the same bytes on every request
+# ============================================================================
+
+def _find_precompressed(folder):
+    """Map relative path -> encodings that have a prebuilt sibling file"""
+    found = {}
+    for encoding in ENCODINGS:
+        suffix = ENCODING_SUFFIXES[encoding]
+        for root, _, files in os.walk(folder):
+            for name in files:
+                if name.endswith(suffix):
+                    rel = os.path.relpath(os.path.join(root, name[:-len(suffix)]), folder).replace(os.sep, '/')
+                    found.setdefault(rel, []).append(encoding)
+    return found
+
+
+# Scanned once at startup; rerun build_assets.py and restart to pick up changes
+_precompressed_static = _find_precompressed(app.static_folder)
+
+
+def send_precompressed(directory, filename, encodings, **kwargs):
+    """send_from_directory, swapping in the .br/.gz sibling the client prefers"""
+    encoding = negotiate_encoding(request.accept_encodings, encodings) if encodings else None
+    if encoding is None:
+        response = send_from_directory(directory, filename, **kwargs)
+    else:
+        mimetype = kwargs.pop('mimetype', None) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_from_directory(directory, filename + ENCODING_SUFFIXES[encoding], mimetype=mimetype, **kwargs)
+        response.headers['Content-Encoding'] = encoding
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def static_file(filename):
+    """Replacement for Flask's static view that prefers precompressed files"""
+    fingerprinted = filename.startswith('dist/')
+    max_age = app.config['IMMUTABLE_MAX_AGE'] if fingerprinted else app.get_send_file_max_age(filename)
+    response = send_precompressed(app.static_folder, filename, _precompressed_static.get(filename), max_age=max_age)
+    if fingerprinted:
+        # The name changes whenever the content does, so never revalidate
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+app.view_functions['static'] = static_file
+
+
+@app.route('/img/<int:width>/<path:name>')
+def resized_image(width, name):
+    """static/img/<name> scaled down to one of ALLOWED_WIDTHS, encoded once and cached on disk"""
+    if width not in ALLOWED_WIDTHS:
+        return page_not_found(None)
+    fmt = choose_format(request.accept_mimetypes, name)
+    path = get_resized(name, width, fmt)
+    if path is None:
+        return page_not_found(None)
+    response = send_file(path, mimetype=output_formats()[fmt][1], max_age=app.config['RESIZED_IMAGE_MAX_AGE'],
+                         conditional=True)
+    # The encoding depends on which image formats the browser advertised
+    response.vary.add('Accept')
+    return response
+
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory('static/img', 'iio-bay-icon.png', mimetype='image/png')
@@ -253,25 +596,29 @@ def redirect_terms():
 
 @app.route('/<lang>/')
 @with_lang
+@cached_page(ttl=app.config['PAGE_CACHE_RANDOM_TTL'])
 def index():
-    random_posts = get_random_posts(limit=9)
+    random_posts = get_random_posts(limit=9, bucket_seconds=app.config['RANDOM_POSTS_BUCKET_SECONDS'])
     return render_template('index.html', random_posts=random_posts)
 
 
 @app.route('/<lang>/about')
 @with_lang
+@cached_page(ttl=app.config['PAGE_CACHE_STATIC_TTL'], depends_on_posts=False)
 def about():
     return render_template('about.html')
 
 
 @app.route('/<lang>/services')
 @with_lang
+@cached_page(ttl=app.config['PAGE_CACHE_STATIC_TTL'], depends_on_posts=False)
 def services():
     return render_template('services.html')
 
 
 @app.route('/<lang>/terms')
 @with_lang
+@cached_page(ttl=app.config['PAGE_CACHE_STATIC_TTL'], depends_on_posts=False)
 def terms():
     return render_template('terms.html')
 
@@ -279,19 +626,38 @@ def terms():
 @app.route('/<lang>/blog')
 @app.route('/<lang>/blog/page/<int:page>')
 @with_lang
+@cached_page(last_modified=lambda **kwargs: get_last_published())
 def blog(page=1):
     data = get_posts_paginated(page=page, per_page=9)
+    # Unknown page numbers 404 (uncached), so they can't fill the page cache
+    if page < 1 or page > max(data['total_pages'], 1):
+        abort(404)
     return render_template('blog.html', posts=data['posts'], page=data['page'], total_pages=data['total_pages'], page_range=data['page_range'])
 
 
+@app.route('/<lang>/search')
+@with_lang
+def search():
+    """Search results page (not cached: the query string is arbitrary, search results are)"""
+    query = request.args.get('q', '').strip()[:200]
+    results = search_posts(query, limit=20) if query else ()
+    return render_template('search.html', query=query, results=results)
+
+
+def _post_last_modified(post_slug):
+    post = get_post_by_slug(post_slug)
+    return post_created_at(post) if post else None
+
+
 @app.route('/post/<path:post_slug>')
+@cached_page(last_modified=_post_last_modified)
 def post(post_slug):
     """Post route without language prefix for backward compatibility"""
     post = get_post_by_slug(post_slug)
     if not post:
         return render_template('404.html'), 404
         
-    return render_template('post.html', post=post)
+    return render_template('post.html', post=post, related_posts=get_related_posts(post['id']))
 
 
 def _handle_contact_submission(data):
@@ -305,22 +671,10 @@ def _handle_contact_submission(data):
     if not turnstile_response:
         return jsonify({"success": False, "message": "Please complete the security verification"}), 400
 
-    # Verify Turnstile token with Cloudflare
-    import requests
-    verify_url = 'https://challenges.cloudflare.com/turnstile/v0/siteverify'
-    verify_data = {
-        'secret': os.getenv('TURNSTILE_SECRET_KEY'),
-        'response': turnstile_response,
-        'remoteip': request.remote_addr
-    }
-
-    try:
-        turnstile_result = requests.post(verify_url, data=verify_data, timeout=5).json()
-        if not turnstile_result.get('success'):
-            return jsonify({"success": False, "message": "Security verification failed. Please try again."}), 400
-    except Exception as e:
-        print(f"Turnstile verification error: {e}")
-        return jsonify({"success": False, "message": "Security verification error. Please try again."}), 500
+    # Verify the Turnstile token in the background while the fields are checked;
+    # the verdict stays cached, so a corrected resubmission reuses it
+    verifier = get_turnstile_verifier()
+    wait_for_verdict = verifier.submit(turnstile_response, request.remote_addr)
 
     # Validate required fields
     if not name or not email_address or not message:
@@ -331,22 +685,34 @@ def _handle_contact_submission(data):
     if not re.match(email_pattern, email_address):
         return jsonify({"success": False, "message": "Invalid email address"}), 400
 
-    if not new_message(name, email_address, subject, message):
-        print("Failed to save message: ", data)
-        return jsonify({"success": False, "message": "Failed to send message"}), 500
+    verdict = wait_for_verdict()
+    if verdict == TURNSTILE_UNAVAILABLE:
+        return jsonify({"success": False, "message": "Security verification error. Please try again."}), 503
+    # A passed token admits one message; a replay finds it already redeemed
+    if verdict != TURNSTILE_PASSED or not verifier.redeem(turnstile_response):
+        return jsonify({"success": False, "message": "Security verification failed. Please try again."}), 400
+
+    # Written in the next batch (see functions/write_queue.py); full means overloaded
+    if not queue_message(name, email_address, subject, message):
+        verifier.unredeem(turnstile_response)
+        # Only counted: the fields are personal data and don't belong in the logs
+        metrics.inc('write_queue_rejected_total', {'kind': 'message'})
+        print("Write queue full, contact message not saved")
+        return jsonify({"success": False, "message": "We're receiving a lot of messages, please try again shortly"}), 503, {'Retry-After': '5'}
 
     return jsonify({"success": True, "message": "Message sent successfully"}), 200
 
 
 @app.route('/<lang>/contact', methods=['GET', 'POST'])
 @with_lang
+@cached_page(ttl=app.config['PAGE_CACHE_RANDOM_TTL'])
 def contact():
     if request.method == 'POST':
         data = request.get_json(silent=True) or {}
         return _handle_contact_submission(data)
 
     # GET
-    random_posts = get_random_posts(limit=6)
+    random_posts = get_random_posts(limit=6, bucket_seconds=app.config['RANDOM_POSTS_BUCKET_SECONDS'])
     return render_template('contact.html', random_posts=random_posts)
 
 
@@ -366,11 +732,40 @@ def newsletter_subscribe():
     if not email_address or not re.match(email_pattern, email_address):
         return jsonify({"message": "Invalid email address"}), 400
 
-    if not new_subscriber(email_address):
-        print("Failed to add new subscriber: ", email_address)
-        return jsonify({"message": "Subscription failed"}), 500
-
-    return jsonify({"message": "Subscription successful"}), 200
+    email_address = normalize_email(email_address)
+    # Repeats are answered from memory, with the same outcome as the first signup
+    if not add_subscriber(email_address):
+        return jsonify({"message": "You are already subscribed", "already_subscribed": True}), 200
+
+    if not queue_subscriber(email_address):
+        forget_subscriber(email_address)
+        metrics.inc('write_queue_rejected_total', {'kind': 'subscriber'})
+        print("Write queue full, subscriber not saved")
+        return jsonify({"message": "Too many requests, please try again shortly"}), 503, {'Retry-After': '5'}
+
+    return jsonify({"message": "Subscription successful", "already_subscribed": False}), 200
+
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Search posts: ?q=<words>&limit=<1-50>, best matches first"""
+    query = request.args.get('q', '').strip()[:200]
+    limit = request.args.get('limit', 10, type=int)
+    results = [
+        {
+            'title': result['title'],
+            'slug': result['slug'],
+            'url': url_for('post', post_slug=result['slug']),
+            'date': result['date'],
+            'image': result['image'],
+            'snippet': str(result['snippet']),
+            'score': result['score'],
+        }
+        for result in search_posts(query, limit=limit)
+    ]
+    response = jsonify({'query': query, 'results': results})
+    response.headers['Cache-Control'] = f"public, max-age={app.config['SEARCH_MAX_AGE']}"
+    return response
 
 
 @app.errorhandler(404)
@@ -381,159 +776,52 @@ def page_not_found(e):
 
 
 # ============================================================================
-# SITEMAP GENERATOR - SEO-OPTIMIZED & PRODUCTION-READY
+# SITEMAP - SEO-OPTIMIZED & PRODUCTION-READY
 # ============================================================================
-# Google-compliant sitemap with:
+# Google-compliant sitemap index plus shards (see functions/sitemap.py):
 # - Valid XML with proper namespaces
 # - Only canonical URLs with language prefixes (/ar/, /en/)
 # - No root (/), no redirects, no query strings
 # - Proper hreflang alternates (ar, en, x-default)
-# - ISO 8601 lastmod dates
+# - ISO 8601 lastmod dates from each post's publish time
 # ============================================================================
 
-# Global cache for sitemap (24-hour in-memory cache)
-_sitemap_cache = {'xml': None, 'timestamp': None}
-
-
-def _generate_sitemap_xml(base_url, languages, default_lang):
-    """
-    Generate Google-compliant sitemap XML.
-    
-    Each page emits ONE <url> block with:
-    - <loc> pointing to Arabic (canonical) URL
-    - hreflang alternates for ar, en, and x-default
-    - <lastmod> in YYYY-MM-DD format
-    """
-    current_time = '2026-01-19'
-    
-    # Public pages that exist in both languages
-    # Only include pages with language prefixes
-    static_pages = [
-        '',         # index - /ar/ and /en/
-        'about',    # /ar/about and /en/about
-        'services', # /ar/services and /en/services
-        'blog',     # /ar/blog and /en/blog
-        'contact',  # /ar/contact and /en/contact
-        'terms',    # /ar/terms and /en/terms
-    ]
-    
-    # Custom lastmod dates for specific pages
-    page_lastmod = {
-        'contact': '2026-01-25',
-    }
-    
-    # Build XML with proper formatting
-    xml_lines = [
-        '<?xml version="1.0" encoding="UTF-8"?>',
-        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"',
-        '        xmlns:xhtml="http://www.w3.org/1999/xhtml">'
-    ]
-    
-    # Generate URL entries for each static page
-    for page in static_pages:
-        # Build URLs for both languages
-        if page == '':
-            url_ar = f"{base_url}/ar/"
-            url_en = f"{base_url}/en/"
-        else:
-            url_ar = f"{base_url}/ar/{page}"
-            url_en = f"{base_url}/en/{page}"
-        
-        # Get lastmod date (custom or default)
-        lastmod = page_lastmod.get(page, current_time)
-        
-        # Emit Arabic <url> block
-        xml_lines.append('  <url>')
-        xml_lines.append(f'    <loc>{url_ar}</loc>')
-        xml_lines.append(f'    <lastmod>{lastmod}</lastmod>')
-        
-        # hreflang alternates
-        xml_lines.append(f'    <xhtml:link rel="alternate" hreflang="ar" href="{url_ar}"/>')
-        xml_lines.append(f'    <xhtml:link rel="alternate" hreflang="en" href="{url_en}"/>')
-        xml_lines.append(f'    <xhtml:link rel="alternate" hreflang="x-default" href="{url_ar}"/>')
-        
-        xml_lines.append('  </url>')
-        
-        # Emit English <url> block
-        xml_lines.append('  <url>')
-        xml_lines.append(f'    <loc>{url_en}</loc>')
-        xml_lines.append(f'    <lastmod>{lastmod}</lastmod>')
-        
-        # hreflang alternates
-        xml_lines.append(f'    <xhtml:link rel="alternate" hreflang="ar" href="{url_ar}"/>')
-        xml_lines.append(f'    <xhtml:link rel="alternate" hreflang="en" href="{url_en}"/>')
-        xml_lines.append(f'    <xhtml:link rel="alternate" hreflang="x-default" href="{url_ar}"/>')
-        
-        xml_lines.append('  </url>')
-    
-    # Add blog posts (language-neutral URLs without prefixes)
-    # Posts don't have hreflang since they're accessed via /post/{slug}
-    try:
-        posts = get_all_posts()
-        for post in posts:
-            if not post.get('slug'):
-                continue
-            
-            post_url = f"{base_url}/post/{quote(post['slug'])}"
-            
-            # Use current_time for all posts
-            post_date = current_time
-            
-            # Posts don't have hreflang (no language alternates)
-            xml_lines.append('  <url>')
-            xml_lines.append(f'    <loc>{post_url}</loc>')
-            xml_lines.append(f'    <lastmod>{post_date}</lastmod>')
-            xml_lines.append('  </url>')
-    except Exception as e:
-        # Don't break sitemap generation if posts fail
-        print(f"Warning: Could not fetch posts for sitemap: {e}")
-    
-    xml_lines.append('</urlset>')
-    
-    return '\n'.join(xml_lines)
+@on_posts_changed
+def _invalidate_post_pages(post_id):
+    """Drop cached pages that list posts and update the post's sitemap shard after a publish"""
+    tags = ['index', 'blog', 'contact']
+    post = get_snapshot().by_id.get(post_id)
+    if post:
+        tags.append(f"post:{post['slug']}")
+    page_cache.invalidate(*tags)
+    update_sitemap_for_post(*sitemap_args(), post_id)
 
 
 @app.route('/sitemap.xml', methods=['GET'])
-def sitemap():
+@app.route('/sitemap-<shard>.xml', methods=['GET'])
+def sitemap(shard=None):
     """
-    Production-ready sitemap endpoint with explicit XML response headers.
+    Sitemap index and shards, served from build/ with their precompressed
+    variants. The files are written on first request (or by build_assets.py)
+    and kept up to date as posts are published.
     """
-    global _sitemap_cache
-    
-    # Force cache refresh if requested (for testing/deployment)
-    force_refresh = request.args.get('refresh') == '1'
-    
-    # Check cache validity
-    cache_timeout = app.config.get('SITEMAP_CACHE_TIMEOUT', 86400)
-    now = datetime.now(timezone.utc).timestamp()
-    
-    if (not force_refresh and
-        _sitemap_cache['xml'] and 
-        _sitemap_cache['timestamp'] and 
-        (now - _sitemap_cache['timestamp']) < cache_timeout):
-        # Serve from cache with explicit headers
-        response = Response(_sitemap_cache['xml'])
-        response.headers['Content-Type'] = 'application/xml; charset=utf-8'
-        return response
-    
-    # Generate fresh sitemap
-    base_url = app.config.get('SITEMAP_BASE_URL', 'https://www.iiot-bay.com')
-    languages = app.config['BABEL_SUPPORTED_LOCALES']
-    default_lang = app.config['BABEL_DEFAULT_LOCALE']
-    
-    sitemap_xml = _generate_sitemap_xml(base_url, languages, default_lang)
-    
-    # Update cache
-    _sitemap_cache['xml'] = sitemap_xml
-    _sitemap_cache['timestamp'] = now
-    
-    # Return with explicit Content-Type header
-    response = Response(sitemap_xml)
+    name = f"sitemap-{shard}.xml" if shard else SITEMAP_INDEX_NAME
+    if not is_sitemap_name(name):
+        return page_not_found(None)
+
+    build_dir = app.config['BUILD_DIR']
+    # Force a full rebuild if requested (for testing/deployment)
+    if request.args.get('refresh') == '1' or not os.path.isfile(os.path.join(build_dir, SITEMAP_PAGES_NAME)):
+        build_sitemap(*sitemap_args())
+    if not os.path.isfile(os.path.join(build_dir, name)):
+        return page_not_found(None)
+
+    encodings = [e for e in ENCODINGS if os.path.isfile(os.path.join(build_dir, name + ENCODING_SUFFIXES[e]))]
+    response = send_precompressed(build_dir, name, encodings, mimetype='application/xml')
     response.headers['Content-Type'] = 'application/xml; charset=utf-8'
     return response
 
 
-
 @app.route('/robots.txt', methods=['GET'])
 def robots():
     with open('robots.txt', 'r') as f:
@@ -567,8 +855,8 @@ def admin_add_new_post():
         content = request.form.get('content', '').strip()
         slug = request.form.get('slug', '').strip()
         
-        # Handle image upload
-        image_filename = ''
+        # Validate the image upload; converting it happens in the background
+        image_file = None
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename:
@@ -582,31 +870,14 @@ def admin_add_new_post():
                                          form_data=request.form)
                 
                 try:
-                    # Generate filename from slug or title
-                    base_name = slug if slug else create_slug(title)
-                    image_filename = f"{base_name}.webp"
-                    
-                    # Open and convert image to WebP
-                    img = Image.open(file.stream)
-                    
-                    # Convert RGBA to RGB if necessary (WebP handles both, but let's be safe)
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        if img.mode == 'P':
-                            img = img.convert('RGBA')
-                        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                        img = background
-                    elif img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    
-                    # Save as WebP
-                    img_path = os.path.join('static', 'img', image_filename)
-                    img.save(img_path, 'WEBP', quality=85, optimize=True)
-                    
+                    # Only parses the header, the pixels are decoded by the worker
+                    Image.open(file.stream)
+                    file.stream.seek(0)
                 except Exception as e:
                     return render_template('add_post.html', 
                                          error=f"Error processing image: {str(e)}",
                                          form_data=request.form)
+                image_file = file
         
         # Validate required fields
         if not title or not author or not content:
@@ -629,12 +900,24 @@ def admin_add_new_post():
                 slug = slug.replace('--', '-')
             slug = slug.strip('-')
         
-        # Prefix image filename with full path to match other posts
-        if image_filename:
-            image_filename = f"/static/img/{image_filename}"
+        if image_file is not None:
+            if get_post_by_slug(slug) is not None:
+                return render_template('add_post.html', 
+                                     error=f"Slug '{slug}' already exists. Please use a different title or slug.",
+                                     form_data=request.form)
+            
+            # The post is published by the image worker once the derivatives exist
+            job_id = enqueue_image_job(image_file.stream, image_file.filename,
+                                       {'title': title, 'date': date, 'author': author,
+                                        'content': content, 'slug': slug})
+            if job_id is None:
+                return render_template('add_post.html', 
+                                     error=f"Slug '{slug}' is already queued. Please use a different title or slug.",
+                                     form_data=request.form)
+            return render_template('add_post.html', job=get_image_job(job_id))
         
         # Insert post into database
-        success, result = add_new_post(title, date, author, content, image_filename, slug)
+        success, result = add_new_post(title, date, author, content, '', slug)
         
         if success:
             return render_template('add_post.html', 
@@ -645,8 +928,37 @@ def admin_add_new_post():
                                  error=result,
                                  form_data=request.form)
     
-    # GET request - show the form
-    return render_template('add_post.html')
+    # GET request - show the form (and, with the key, the status of a queued post)
+    job = None
+    if request.args.get('job'):
+        if not key_matches(request_key(), 'admin_add_new_post_key'):
+            return render_template('add_post.html', error="Invalid access key! Access denied."), 403
+        job = get_image_job(request.args['job'])
+    return render_template('add_post.html', job=job)
+
+
+@app.route('/admin/metrics', methods=['GET'])
+def admin_metrics():
+    """Prometheus metrics of every worker; key as a Bearer token or ?key="""
+    if not key_matches(request_key(), 'METRICS_KEY'):
+        return jsonify({'error': 'Access denied'}), 403
+    response = Response(metrics.render_prometheus(metrics.collect()), mimetype='text/plain')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/admin/image-jobs/<job_id>', methods=['GET'])
+def admin_image_job_status(job_id):
+    """Status of a queued post image, polled by the add-post form; admin key as a Bearer token or ?key="""
+    if not key_matches(request_key(), 'admin_add_new_post_key'):
+        return jsonify({'error': 'Access denied'}), 403
+    job = get_image_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    response = jsonify(job)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
 # if __name__ == '__main__':
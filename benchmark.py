@@ -0,0 +1,100 @@
+"""
+Requests-per-second benchmark for the SQLite connection layer.
+
+Page routes read posts from the in-memory snapshot (functions/post_store.py)
+and no longer query SQLite per request, so the benchmark uses /api/search,
+the endpoint that still does. Every request sends a different two-word query,
+so the search result cache misses and each request runs an FTS query through
+db_connection(). It runs once with a fresh SQLite connection per call
+(DB_POOLING=0) and once with the pooled WAL connections, from several
+threads, and prints both results side by side.
+
+Usage:
+    python benchmark.py [--requests 500] [--threads 4]
+"""
+import argparse, itertools, json, os, subprocess, sys, threading, time
+
+
+BASE_URL = 'https://www.iiot-bay.com'
+ROUTE = '/api/search'
+
+
+def search_queries():
+    """Endless distinct two-word queries built from the post titles"""
+    from functions.post_store import get_all_posts
+    from functions.seo import WORD_RE
+    words = sorted({w.lower() for p in get_all_posts() for w in WORD_RE.findall(p['title'] or '') if len(w) > 2})
+    words = words or ['iot']
+    pairs = itertools.product(words, repeat=2)
+    return (f"{a} {b}{n or ''}" for n in itertools.count() for a, b in pairs)
+
+
+def run_route(total_requests, threads):
+    """Send total_requests distinct searches across threads, return requests/second"""
+    from app import app
+
+    per_thread = max(1, total_requests // threads)
+    queries = search_queries()
+    paths = [[f"{ROUTE}?q={next(queries)}" for _ in range(per_thread)] for _ in range(threads)]
+    errors = []
+
+    def worker(thread_paths):
+        client = app.test_client()
+        for path in thread_paths:
+            response = client.get(path, base_url=BASE_URL)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    # Warm up the app and connections before timing
+    app.test_client().get(f"{ROUTE}?q=warmup", base_url=BASE_URL)
+
+    workers = [threading.Thread(target=worker, args=(thread_paths,)) for thread_paths in paths]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    if errors:
+        print(f"  {ROUTE}: {len(errors)} non-200 responses (e.g. {errors[0]})", file=sys.stderr)
+    return (per_thread * threads) / elapsed
+
+
+def run_child(args):
+    """Benchmark in this process and print JSON results"""
+    print(json.dumps({ROUTE: run_route(args.requests, args.threads)}))
+
+
+def run_mode(pooling, args):
+    env = dict(os.environ, DB_POOLING='1' if pooling else '0')
+    cmd = [sys.executable, __file__, '--child',
+           '--requests', str(args.requests), '--threads', str(args.threads)]
+    output = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True).stdout
+    # The app prints its own log lines, results are the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500, help='requests per mode')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent client threads')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    before = run_mode(False, args)
+    after = run_mode(True, args)
+
+    width = max(len(path) for path in before) + 2
+    print(f"{'route':<{width}} {'before':>10} {'after':>10} {'change':>8}")
+    for path in before:
+        change = (after[path] / before[path] - 1) * 100 if before[path] else 0
+        print(f"{path:<{width}} {before[path]:>8.1f}/s {after[path]:>8.1f}/s {change:>+7.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Asset build step, run before (re)starting the app on deploy.
+
+- Minifies CSS/JS and copies every CSS, JS and image file under static/ to
+  static/dist/ with a content hash in its name, recording the mapping in
+  static/dist/manifest.json. url_for('static', ...) resolves through the
+  manifest, and hashed files are served with an immutable, one-year policy.
+- Precompresses static/css, static/js and the hashed CSS/JS to .gz and .br
+  siblings, which the app serves directly to clients that accept them.
+- Renders the sitemap index and shards into build/ together with .gz/.br
+  variants; publishing a post updates them in place (see functions/sitemap.py).
+
+Usage:
+    python build_assets.py [--skip-sitemap] [--skip-fingerprint] [--force]
+"""
+import argparse, hashlib, json, os, re, shutil
+from pathlib import Path
+from functions.compression import ENCODINGS, ENCODING_SUFFIXES, compress
+
+
+ROOT = Path(__file__).resolve().parent
+STATIC_DIR = ROOT / 'static'
+BUILD_DIR = ROOT / 'build'
+DIST_DIR = STATIC_DIR / 'dist'
+MANIFEST_PATH = DIST_DIR / 'manifest.json'
+
+# Directories (under static/) and suffixes that get content-hashed names.
+# Images come first so stylesheets can be rewritten to point at their hashed names
+FINGERPRINT_DIRS = ('img', 'css', 'js')
+FINGERPRINT_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp', '.avif', '.gif', '.svg', '.ico', '.css', '.js')
+
+# Directories (under static/) and suffixes that get precompressed
+PRECOMPRESS_DIRS = ('css', 'js')
+PRECOMPRESS_SUFFIXES = ('.css', '.js')
+
+
+def write_variants(path: Path, data: bytes, force: bool = False) -> int:
+    """Write every compressed variant of data next to path, returns files written"""
+    written = 0
+    for encoding in ENCODINGS:
+        target = path.with_name(path.name + ENCODING_SUFFIXES[encoding])
+        if not force and target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+            continue
+        target.write_bytes(compress(data, encoding, level='static'))
+        written += 1
+    return written
+
+
+def precompress_static(force: bool = False):
+    for folder in PRECOMPRESS_DIRS:
+        for path in sorted((STATIC_DIR / folder).rglob('*')):
+            if path.suffix not in PRECOMPRESS_SUFFIXES:
+                continue
+            written = write_variants(path, path.read_bytes(), force)
+            print(f"{'Compressed' if written else 'Up to date'}: {path.relative_to(ROOT)}")
+
+
+def minify_css(data: bytes) -> bytes:
+    try:
+        import rcssmin
+    except ImportError:  # optional build dependency
+        return data
+    return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+
+
+def minify_js(data: bytes) -> bytes:
+    try:
+        import rjsmin
+    except ImportError:  # optional build dependency
+        return data
+    return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+
+
+def rewrite_css_urls(data: bytes, manifest: dict) -> bytes:
+    """Point url(/static/...) references at their hashed copies"""
+    def replace(match):
+        quote, path = match.group(1), match.group(2)
+        return f"url({quote}/static/{manifest.get(path, path)}{quote})"
+    return re.sub(r"url\((['\"]?)/static/([^'\")]+)\1\)", replace, data.decode('utf-8')).encode('utf-8')
+
+
+def hashed_name(rel: str, data: bytes) -> str:
+    """css/style.css -> css/style.<hash>.css"""
+    digest = hashlib.blake2b(data, digest_size=6).hexdigest()
+    stem, _, suffix = rel.rpartition('.')
+    return f"{stem}.{digest}.{suffix}"
+
+
+def fingerprint_assets(force: bool = False) -> dict:
+    """Write hashed (and minified) copies to static/dist, returns the manifest"""
+    manifest = {}
+    DIST_DIR.mkdir(exist_ok=True)
+
+    for folder in FINGERPRINT_DIRS:
+        for path in sorted((STATIC_DIR / folder).rglob('*')):
+            if not path.is_file() or path.suffix.lower() not in FINGERPRINT_SUFFIXES:
+                continue
+            rel = path.relative_to(STATIC_DIR).as_posix()
+            data = path.read_bytes()
+            if path.suffix == '.css':
+                data = rewrite_css_urls(minify_css(data), manifest)
+            elif path.suffix == '.js':
+                data = minify_js(data)
+
+            hashed = hashed_name(rel, data)
+            target = DIST_DIR / hashed
+            if force or not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                if path.suffix in ('.css', '.js'):
+                    target.write_bytes(data)
+                else:
+                    # Images aren't transformed, so a hard link avoids a second copy
+                    try:
+                        if target.exists():
+                            target.unlink()
+                        os.link(path, target)
+                    except OSError:
+                        shutil.copy2(path, target)
+            if path.suffix in ('.css', '.js'):
+                write_variants(target, data, force)
+            manifest[rel] = f"dist/{hashed}"
+
+    try:
+        previous = json.loads(MANIFEST_PATH.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        previous = {}
+    tmp = MANIFEST_PATH.with_suffix('.tmp')
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, MANIFEST_PATH)
+    prune_dist(manifest, previous)
+    print(f"Fingerprinted {len(manifest)} assets into {DIST_DIR.relative_to(ROOT)}")
+    return manifest
+
+
+def prune_dist(manifest: dict, previous: dict = None):
+    """
+    Delete hashed files (and their variants) in neither the manifest nor the
+    previous one: pages cached by browsers and CDNs before this deploy still
+    reference the previous hashes.
+    """
+    keep = {DIST_DIR.parent / p for p in (*manifest.values(), *(previous or {}).values())}
+    for path in DIST_DIR.rglob('*'):
+        if not path.is_file() or path == MANIFEST_PATH:
+            continue
+        original = path
+        for suffix in ENCODING_SUFFIXES.values():
+            if path.name.endswith(suffix):
+                original = path.with_name(path.name[:-len(suffix)])
+        if original not in keep:
+            path.unlink()
+
+
+def build_sitemap():
+    from functions.site_config import sitemap_args
+    from functions.sitemap import build_all
+
+    shards = build_all(*sitemap_args())
+    print(f"Built: {BUILD_DIR.relative_to(ROOT)}/sitemap.xml (index of pages + {shards} post shard(s))")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--skip-sitemap', action='store_true', help="don't prebuild the sitemap")
+    parser.add_argument('--skip-fingerprint', action='store_true', help="don't build static/dist")
+    parser.add_argument('--force', action='store_true', help='rebuild files that look up to date')
+    args = parser.parse_args()
+
+    precompress_static(args.force)
+    if not args.skip_fingerprint:
+        fingerprint_assets(args.force)
+    if not args.skip_sitemap:
+        build_sitemap()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+Pluggable cache backends shared by the sitemap, the page cache and the post store.
+
+Two implementations share one small interface (bytes values with an optional
+TTL, plus integer counters used as version numbers):
+
+- InProcessCache: a dict guarded by a lock, private to one worker process.
+- SQLiteCache: a separate local SQLite file every gunicorn worker opens, so a
+  page rendered or a version bumped in one worker is visible to all of them.
+
+CACHE_BACKEND selects which one get_cache() returns ('sqlite' by default,
+'memory' for a single-process setup).
+"""
+import os, sqlite3, threading, time
+
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'iiot_bay_cache.db'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+
+class CacheBackend:
+    """Interface every cache backend implements"""
+
+    def get(self, key: str):
+        """Stored bytes for key, or None if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_counter(self, name: str) -> int:
+        """Current value of a counter (0 if it was never incremented)"""
+        raise NotImplementedError
+
+    def incr(self, name: str) -> int:
+        """Atomically increment a counter and return its new value"""
+        raise NotImplementedError
+
+
+class InProcessCache(CacheBackend):
+    """Cache private to the current process"""
+
+    def __init__(self):
+        self._entries = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_counter(self, name):
+        return self._counters.get(name, 0)
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache stored in a local SQLite file shared by every worker on the host.
+
+    Failures are logged and treated as misses so a broken cache never takes a
+    page down; a counter read that fails returns the last value read (and
+    raises if there is none), never 0, which would pass for a stale version. Expired rows are purged, and the oldest rows evicted once the
+    table grows past max_bytes, every PURGE_EVERY writes.
+    """
+    PURGE_EVERY = 100
+
+    def __init__(self, path: str = CACHE_DB_PATH, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        self._last_counters = {}
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,
+                    expires_at REAL, stored_at REAL NOT NULL)""")
+                conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        try:
+            row = self._conn().execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Cache read error for {key}: {e}")
+            return None
+        if row is None or (row[1] is not None and time.time() >= row[1]):
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO cache (key, value, size, expires_at, stored_at) VALUES (?, ?, ?, ?, ?)",
+                             (key, value, len(value), now + ttl if ttl else None, now))
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self.purge()
+        except sqlite3.Error as e:
+            print(f"Cache write error for {key}: {e}")
+
+    def delete(self, *keys):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany("DELETE FROM cache WHERE key = ?", [(k,) for k in keys])
+        except sqlite3.Error as e:
+            print(f"Cache delete error: {e}")
+
+    def clear(self):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM cache")
+        except sqlite3.Error as e:
+            print(f"Cache clear error: {e}")
+
+    def purge(self):
+        """Remove expired rows, then the oldest ones while over max_bytes"""
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            excess = total - self.max_bytes
+            freed = 0
+            keys = []
+            for key, size in conn.execute("SELECT key, size FROM cache ORDER BY stored_at"):
+                keys.append((key,))
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany("DELETE FROM cache WHERE key = ?", keys)
+
+    def get_counter(self, name):
+        try:
+            row = self._conn().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        except sqlite3.Error as e:
+            # 0 would look like a valid (old) version; the last value read is the best guess
+            if name not in self._last_counters:
+                raise
+            print(f"Cache counter read error for {name}, using the last value read: {e}")
+            return self._last_counters[name]
+        value = row[0] if row else 0
+        self._last_counters[name] = value
+        return value
+
+    def incr(self, name):
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO counters (name, value) VALUES (?, 1) "
+                         "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+            value = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+        self._last_counters[name] = value
+        return value
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CacheBackend:
+    """The process-wide cache backend selected by CACHE_BACKEND"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SQLiteCache() if CACHE_BACKEND == 'sqlite' else InProcessCache()
+    return _cache
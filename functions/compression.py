@@ -0,0 +1,72 @@
+"""
+Response compression helpers: Accept-Encoding negotiation plus gzip/brotli encoders.
+
+Brotli is used when the brotli package is installed; otherwise everything
+falls back to gzip.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+
+# Preferred first when the client weights encodings equally
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+# File suffix of precompressed static files for each encoding
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Smaller bodies aren't worth the CPU (and can grow when compressed)
+MIN_COMPRESS_SIZE = 512
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript',
+    'application/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+}
+
+
+def negotiate_encoding(accept_encodings, available=ENCODINGS):
+    """Best encoding from available the client accepts (werkzeug Accept object), or None"""
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# (brotli quality, gzip level) per use: per-response compression has to be
+# cheap, cached pages are compressed once per render, build artifacts once
+# per deploy
+COMPRESSION_LEVELS = {
+    'dynamic': (5, 6),
+    'cached': (9, 9),
+    'static': (11, 9),
+}
+
+
+def compress(body: bytes, encoding: str, level: str = 'dynamic') -> bytes:
+    """Compress body with encoding at one of the COMPRESSION_LEVELS"""
+    brotli_quality, gzip_level = COMPRESSION_LEVELS[level]
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=gzip_level)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def compress_variants(body: bytes, level: str = 'cached') -> dict:
+    """Every supported encoding of body, keyed by encoding name"""
+    return {encoding: compress(body, encoding, level) for encoding in ENCODINGS}
+
+
+def is_compressible(response) -> bool:
+    """Whether an outgoing Flask response should be compressed on the fly"""
+    return (response.status_code in (200, 404) and
+            not response.direct_passthrough and
+            not response.is_streamed and
+            'Content-Encoding' not in response.headers and
+            response.mimetype in COMPRESSIBLE_MIMETYPES and
+            (response.content_length or 0) >= MIN_COMPRESS_SIZE)
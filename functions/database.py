@@ -1,106 +1,370 @@
-import sqlite3, os
+import sqlite3, os, re, threading, atexit, random, time, json, weakref
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from functions.seo import post_text_fields, search_index_fields
+from functions.metrics import observe
 # from typing import List, Dict
 
 
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'iiot_bay_database.db')
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# Reuse one connection per thread inside each worker process (set DB_POOLING=0 to
+# fall back to a fresh connection per call, e.g. for benchmarking)
+DB_POOLING = os.getenv('DB_POOLING', '1') != '0'
+
+# Applied once per connection when it is opened
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # readers no longer block on the writer
+    "PRAGMA synchronous=NORMAL",    # safe with WAL, fsync only at checkpoints
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",     # ~16 MB page cache per connection
+    "PRAGMA mmap_size=67108864",    # 64 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Compiled statements kept per connection (keyed by SQL text)
+DB_CACHED_STATEMENTS = 128
+
+_local = threading.local()
+_pool_lock = threading.Lock()
+# Open pooled connections, for close_all_connections(). Each is closed as soon
+# as its thread exits (see get_db), so short-lived threads don't leak handles
+_pool = set()
+
+# Callbacks run with the new post id after add_new_post() commits (the first list first)
+_first_post_change_hooks = []
+_post_change_hooks = []
+
+# Columns computed from the post body at publish time (see functions/seo.py)
+POST_TEXT_COLUMNS = {
+    'excerpt': 'TEXT',
+    'meta_description': 'TEXT',
+    'word_count': 'INTEGER',
+    'reading_time': 'INTEGER',
+}
+
+# Columns added to the images table after it was introduced
+IMAGE_PLACEHOLDER_COLUMNS = {
+    'placeholder': 'TEXT',      # data: URI of a ~20px thumbnail shown while the image loads
+    'dominant_color': 'TEXT',   # '#rrggbb'
+}
+
+# posts.created_at is UTC text, the same format as SQLite's CURRENT_TIMESTAMP
+CREATED_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def utc_timestamp() -> str:
+    """Current time for a created_at column"""
+    return datetime.now(timezone.utc).strftime(CREATED_AT_FORMAT)
+
+
+def parse_created_at(value):
+    """A created_at value as an aware UTC datetime, None if unparseable"""
+    try:
+        return datetime.strptime(value, CREATED_AT_FORMAT).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?)\s+(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=512)
+def _statement_labels(sql: str) -> dict:
+    """{'statement': 'SELECT', 'table': 'posts'} for the query timing metric"""
+    words = sql.split(None, 1)
+    table = _TABLE_RE.search(sql)
+    return {'statement': words[0].upper() if words else '', 'table': table.group(1) if table else ''}
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection that reports execute()/executemany() and commit times to functions.metrics"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe('sqlite_query_duration_seconds', _statement_labels(sql), time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe('sqlite_query_duration_seconds', _statement_labels(sql), time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observe('sqlite_query_duration_seconds', {'statement': 'COMMIT', 'table': ''}, time.perf_counter() - start)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # `with conn:` commits (or rolls back) here without going through commit()
+        start = time.perf_counter()
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            statement = 'ROLLBACK' if exc_type else 'COMMIT'
+            observe('sqlite_query_duration_seconds', {'statement': statement, 'table': ''}, time.perf_counter() - start)
+
+
+def open_connection(check_same_thread: bool = True):
+    """Open a new tuned connection (callers own and close it)"""
+    conn = sqlite3.connect(DB_PATH, timeout=5, cached_statements=DB_CACHED_STATEMENTS,
+                           check_same_thread=check_same_thread, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
-def new_subscriber(email: str) -> bool:
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO newsletter_subscribers (email) VALUES (?)", (email,))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        print("Error adding subscriber:", e)
-        return False
 
-def new_message(name: str, email: str, subject: str, message: str) -> bool:
+def get_db():
+    """Return this thread's pooled connection, opening it on first use"""
+    if not DB_POOLING:
+        return open_connection()
+
+    holder = getattr(_local, 'holder', None)
+    # Connections must not cross a fork (gunicorn --preload), so key them by pid
+    if holder is None or holder.pid != os.getpid():
+        holder = _ThreadConnection(open_connection())
+        _local.holder = holder
+        with _pool_lock:
+            _pool.add(holder.conn)
+        # Runs when the thread exits and its threading.local values are dropped
+        weakref.finalize(holder, _release_connection, holder.conn)
+    return holder.conn
+
+
+class _ThreadConnection:
+    """A thread's pooled connection; only referenced from that thread's _local"""
+    __slots__ = ('conn', 'pid', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pid = os.getpid()
+
+
+def _release_connection(conn):
+    with _pool_lock:
+        if conn not in _pool:
+            return  # closed by close_all_connections() or a fork
+        _pool.discard(conn)
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO contact_messages (full_name, email_address, subject, message) VALUES (?, ?, ?, ?)",
-                    (name, email, subject, message))
-        conn.commit()
         conn.close()
-        return True
-    except Exception as e:
-        print("Error saving contact message:", e)
-        return False
+    except sqlite3.Error:
+        pass  # closed on deallocation instead
 
-def get_posts_paginated(page: int = 1, per_page: int = 9):
-    """Get paginated blog posts with pagination metadata"""
+
+@contextmanager
+def db_connection():
+    """Borrow a connection; only closed afterwards when pooling is disabled"""
     conn = get_db()
-    cur = conn.cursor()
-    
-    # Get total posts count
-    cur.execute("SELECT COUNT(1) FROM posts")
-    total_posts = cur.fetchone()[0]
-    total_pages = (total_posts + per_page - 1) // per_page  # Ceiling division
-    
-    # Calculate offset
-    start = (page - 1) * per_page
-    
-    # Get posts for current page (newest first)
-    cur.execute("SELECT * FROM posts ORDER BY id DESC LIMIT ? OFFSET ?", (per_page, start))
-    rows = cur.fetchall()
-    paginated_posts = [dict(r) for r in rows]
-    conn.close()
-    
-    # Calculate page range for pagination display
-    page_range = []
+    try:
+        yield conn
+    finally:
+        if not DB_POOLING:
+            conn.close()
+
+
+def on_posts_changed(func=None, *, first=False):
+    """
+    Register func(post_id) to run after a post is published (usable as a
+    decorator). Hooks registered with first=True run before the others, so data
+    they write is already there when post_store bumps the posts version.
+    """
+    if func is None:
+        return lambda f: on_posts_changed(f, first=first)
+    (_first_post_change_hooks if first else _post_change_hooks).append(func)
+    return func
+
+
+def _notify_posts_changed(post_id):
+    for hook in _first_post_change_hooks + _post_change_hooks:
+        try:
+            hook(post_id)
+        except Exception as e:
+            print(f"Post change hook {getattr(hook, '__name__', hook)} failed: {e}")
+
+
+def build_page_range(page: int, total_pages: int) -> list:
+    """Page numbers (and '...' gaps) shown in the blog pagination bar"""
     if total_pages <= 7:
-        page_range = list(range(1, total_pages + 1))
-    else:
-        if page <= 4:
-            page_range = list(range(1, 6)) + ['...', total_pages]
-        elif page >= total_pages - 3:
-            page_range = [1, '...'] + list(range(total_pages - 4, total_pages + 1))
-        else:
-            page_range = [1, '...'] + list(range(page - 1, page + 2)) + ['...', total_pages]
-    
-    return {
-        'posts': paginated_posts,
-        'page': page,
-        'total_pages': total_pages,
-        'page_range': page_range
-    }
+        return list(range(1, total_pages + 1))
+    if page <= 4:
+        return list(range(1, 6)) + ['...', total_pages]
+    if page >= total_pages - 3:
+        return [1, '...'] + list(range(total_pages - 4, total_pages + 1))
+    return [1, '...'] + list(range(page - 1, page + 2)) + ['...', total_pages]
+
+
+@atexit.register
+def close_all_connections():
+    """Close every pooled connection opened by this process"""
+    with _pool_lock:
+        for conn in list(_pool):
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _pool.clear()
+    _local.__dict__.clear()
+
+
+def _add_missing_columns(conn, table, columns):
+    existing = {r['name'] for r in conn.execute(f"PRAGMA table_info({table})")}
+    for name, sql_type in columns.items():
+        if name in existing:
+            continue
+        try:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {sql_type}")
+        except sqlite3.OperationalError as e:
+            # Another worker may have added it between the check and the ALTER
+            if 'duplicate column' not in str(e):
+                raise
+
+
+def init_db():
+    """Bring an existing database up to the current schema (safe to run on every start)"""
+    with db_connection() as conn, conn:
+        _add_missing_columns(conn, 'posts', POST_TEXT_COLUMNS)
+        # Responsive derivatives per source image, keyed by its URL (see functions/images.py)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                width INTEGER,
+                height INTEGER,
+                variants TEXT NOT NULL,
+                created_at TEXT
+            )
+        """)
+        _add_missing_columns(conn, 'images', IMAGE_PLACEHOLDER_COLUMNS)
+        # Full-text index of normalised titles/bodies, rowid = posts.id (see functions/search.py)
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, body, tokenize = 'unicode61 remove_diacritics 2')")
+        # Top neighbours of every post (see functions/related_posts.py)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS related_posts (
+                post_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                related_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (post_id, rank)
+            ) WITHOUT ROWID
+        """)
+        # Background image processing for new posts (see functions/image_jobs.py)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                upload_path TEXT NOT NULL,
+                base_name TEXT NOT NULL,
+                post TEXT NOT NULL,
+                post_id INTEGER,
+                error TEXT,
+                run_after REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_image_jobs_status ON image_jobs (status, run_after)")
+
+
+def _index_posts(conn, posts):
+    rows = []
+    for post in posts:
+        fields = search_index_fields(post['title'], post['content'])
+        rows.append((post['id'], fields['title'], fields['body']))
+    conn.executemany("INSERT OR REPLACE INTO posts_fts (rowid, title, body) VALUES (?, ?, ?)", rows)
+
+
+def rebuild_search_index(only_if_stale: bool = False) -> int:
+    """Re-index every post (only when the index is missing posts with only_if_stale), returns posts indexed"""
+    with db_connection() as conn, conn:
+        if only_if_stale:
+            indexed = conn.execute("SELECT COUNT(1) FROM posts_fts").fetchone()[0]
+            if indexed == conn.execute("SELECT COUNT(1) FROM posts").fetchone()[0]:
+                return 0
+        posts = conn.execute("SELECT id, title, content FROM posts").fetchall()
+        conn.execute("DELETE FROM posts_fts")
+        _index_posts(conn, posts)
+    return len(posts)
+
+
+def backfill_post_text_fields(only_missing: bool = True) -> int:
+    """Compute excerpt/meta/word count/reading time for existing posts, returns rows updated"""
+    init_db()
+    query = "SELECT id, content FROM posts"
+    if only_missing:
+        query += " WHERE excerpt IS NULL"
+    with db_connection() as conn, conn:
+        rows = conn.execute(query).fetchall()
+        for row in rows:
+            fields = post_text_fields(row['content'])
+            conn.execute("""
+                UPDATE posts SET excerpt = ?, meta_description = ?, word_count = ?, reading_time = ?
+                WHERE id = ?
+            """, (fields['excerpt'], fields['meta_description'], fields['word_count'],
+                  fields['reading_time'], row['id']))
+    return len(rows)
+
+
+def save_image_variants(path: str, record: dict):
+    """Record the derivatives generated for the image at path (replaces earlier ones)"""
+    with db_connection() as conn, conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO images (path, width, height, variants, placeholder, dominant_color, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (path, record['width'], record['height'], json.dumps(record['variants'], ensure_ascii=False),
+              record.get('placeholder'), record.get('dominant_color'), utc_timestamp()))
+
+
+def save_image_placeholder(path: str, placeholder: str, dominant_color: str):
+    """Set the placeholder of an image recorded before placeholders existed"""
+    with db_connection() as conn, conn:
+        conn.execute("UPDATE images SET placeholder = ?, dominant_color = ? WHERE path = ?",
+                     (placeholder, dominant_color, path))
+
+
+def get_image_paths() -> dict:
+    """Path of every image that already has derivatives -> whether it has a placeholder too"""
+    with db_connection() as conn:
+        return {r['path']: r['placeholder'] is not None for r in conn.execute("SELECT path, placeholder FROM images")}
+
 
 def get_post_by_slug(post_slug: str):
     """Get a single post by its slug"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM posts WHERE slug=?", (post_slug,))
-    row = cur.fetchone()
-    post = dict(row) if row else None
-    conn.close()
-    return post
-
-def get_all_posts():
-    """Get all posts for sitemap generation"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT slug, created_at FROM posts ORDER BY id DESC")
-    rows = cur.fetchall()
-    posts = [dict(r) for r in rows]
-    conn.close()
-    return posts
-
-def get_random_posts(limit: int = 6):
-    """Get random posts for homepage carousel"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM posts ORDER BY RANDOM() LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    random_posts = [dict(r) for r in rows]
-    conn.close()
-    return random_posts
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM posts WHERE slug=?", (post_slug,)).fetchone()
+    return dict(row) if row else None
+
+def sample_ids(ids, k: int, seed=None, bucket_seconds=None) -> list:
+    """
+    Pick k ids without replacement in O(k).
+
+    With a seed, or a bucket_seconds window (the seed becomes the current time
+    bucket), every worker picks the same ids until the window rolls over, so
+    the result can be cached for that long.
+    """
+    if bucket_seconds:
+        seed = int(time.time() // bucket_seconds)
+    rng = random.Random(seed) if seed is not None else random
+    return rng.sample(ids, min(k, len(ids)))
+
+
+def shift_created_at(hours: float, until_id: int) -> int:
+    """
+    Move created_at of posts up to until_id by hours, for rows written in the
+    server's local time before add_new_post stored UTC. Returns rows changed.
+    """
+    with db_connection() as conn, conn:
+        cur = conn.execute("UPDATE posts SET created_at = strftime('%Y-%m-%d %H:%M:%S', created_at, ?) "
+                           "WHERE id <= ? AND created_at IS NOT NULL", (f"{hours:+g} hours", until_id))
+    return cur.rowcount
+
 
 def create_slug(title: str) -> str:
     """Create a URL-friendly slug from the title"""
@@ -115,24 +379,28 @@ def create_slug(title: str) -> str:
     slug = slug.strip('-')
     return slug
 
-def add_new_post(title: str, date: str, author: str, content: str, image: str, slug: str) -> tuple:
-    """Insert a new blog post into the database"""
+def add_new_post(title: str, date: str, author: str, content: str, image: str, slug: str,
+                 image_job_id: str = None) -> tuple:
+    """Insert a new blog post into the database (and mark image_job_id as its publisher)"""
     try:
-        from datetime import datetime
-        conn = get_db()
-        cur = conn.cursor()
-        
-        created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        cur.execute("""
-            INSERT INTO posts (title, date, author, content, image, slug, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (title, date, author, content, image, slug, created_at))
-        
-        conn.commit()
-        post_id = cur.lastrowid
-        conn.close()
-        
+        # UTC, like CURRENT_TIMESTAMP: Last-Modified and the sitemap's lastmod read it as such
+        created_at = utc_timestamp()
+        fields = post_text_fields(content)
+
+        with db_connection() as conn, conn:
+            cur = conn.execute("""
+                INSERT INTO posts (title, date, author, content, image, slug, created_at,
+                                   excerpt, meta_description, word_count, reading_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (title, date, author, content, image, slug, created_at,
+                  fields['excerpt'], fields['meta_description'], fields['word_count'], fields['reading_time']))
+            post_id = cur.lastrowid
+            # Same transaction, so the post is searchable as soon as it is visible
+            _index_posts(conn, [{'id': post_id, 'title': title, 'content': content}])
+            if image_job_id is not None:
+                conn.execute("UPDATE image_jobs SET post_id = ? WHERE id = ?", (post_id, image_job_id))
+
+        _notify_posts_changed(post_id)
         return True, post_id
     except sqlite3.IntegrityError as e:
         return False, f"Slug '{slug}' already exists. Please use a different title or slug."
@@ -0,0 +1,187 @@
+"""
+Background queue for post image processing.
+
+admin_add_new_post stores the raw upload under UPLOAD_DIR, records a job in
+the image_jobs table and returns right away. Worker threads claim jobs
+atomically (so several gunicorn workers can share the queue), build the WebP
+and its responsive derivatives, and publish the post once they exist. Failed
+jobs are retried with exponential backoff up to IMAGE_JOB_MAX_ATTEMPTS times.
+
+Every app process runs IMAGE_WORKER_THREADS workers (0 disables them);
+`python manage.py image-worker` drains the queue from a dedicated process.
+"""
+import json, os, shutil, threading, time, uuid
+from functions.database import db_connection, add_new_post, get_post_by_slug, save_image_variants
+from functions.images import save_upload
+
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'uploads')
+
+IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv('IMAGE_JOB_MAX_ATTEMPTS', '3'))
+IMAGE_JOB_RETRY_DELAY = 5       # seconds before the first retry, doubled after each failure
+IMAGE_JOB_POLL_INTERVAL = 2.0   # seconds between queue checks when idle
+IMAGE_JOB_STALE_AFTER = 600     # running jobs older than this belonged to a dead worker
+
+# Set when a job is enqueued in this process so local workers skip the poll wait
+_wakeup = threading.Event()
+_workers = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+class PermanentJobError(Exception):
+    """A failure retrying can't fix (e.g. the slug was taken meanwhile)"""
+
+
+def _now():
+    return time.time()
+
+
+def enqueue(stream, filename: str, post: dict):
+    """
+    Store the upload and queue it; post holds title/date/author/content/slug.
+    Returns the job id, or None when a queued job already claims the slug.
+    """
+    job_id = uuid.uuid4().hex
+    ext = os.path.splitext(filename)[1].lower()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    upload_path = os.path.join(UPLOAD_DIR, f"{job_id}{ext}")
+    with open(upload_path, 'wb') as f:
+        shutil.copyfileobj(stream, f, 1024 * 1024)
+
+    now = _now()
+    with db_connection() as conn, conn:
+        # Checked in the INSERT itself so two concurrent requests can't both queue a slug
+        cur = conn.execute("""
+            INSERT INTO image_jobs (id, status, attempts, upload_path, base_name, post, run_after, created_at, updated_at)
+            SELECT ?, 'pending', 0, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM image_jobs WHERE base_name = ? AND status IN ('pending', 'running'))
+        """, (job_id, upload_path, post['slug'], json.dumps(post, ensure_ascii=False), now, now, now, post['slug']))
+    if cur.rowcount == 0:
+        os.remove(upload_path)
+        return None
+
+    # Workers don't survive a fork (gunicorn --preload), so make sure this process has some
+    start_workers()
+    _wakeup.set()
+    return job_id
+
+
+def get_job(job_id: str):
+    """Status of a job as a dict (without the raw post body), or None"""
+    with db_connection() as conn:
+        row = conn.execute("""
+            SELECT id, status, attempts, error, post_id, base_name, created_at, updated_at
+            FROM image_jobs WHERE id = ?
+        """, (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['max_attempts'] = IMAGE_JOB_MAX_ATTEMPTS
+    job['post_url'] = f"/post/{job['base_name']}" if job['status'] == 'done' else None
+    return job
+
+
+def claim_job():
+    """Atomically mark the next due job as running and return it, or None"""
+    now = _now()
+    with db_connection() as conn, conn:
+        # Jobs stuck in 'running' were claimed by a worker that died
+        conn.execute("""
+            UPDATE image_jobs SET status = 'pending', updated_at = ?
+            WHERE status = 'running' AND updated_at < ?
+        """, (now, now - IMAGE_JOB_STALE_AFTER))
+        row = conn.execute("""
+            UPDATE image_jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+            WHERE id = (SELECT id FROM image_jobs WHERE status = 'pending' AND run_after <= ?
+                        ORDER BY created_at LIMIT 1)
+            RETURNING *
+        """, (now, now)).fetchone()
+    return dict(row) if row else None
+
+
+def _update(job_id, **fields):
+    fields['updated_at'] = _now()
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    with db_connection() as conn, conn:
+        conn.execute(f"UPDATE image_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def run_job(job: dict) -> int:
+    """Build the images and publish the post, returns the post id"""
+    # add_new_post records the id in the publishing transaction, so a set post_id
+    # means a previous attempt published before its worker died
+    if job['post_id'] is not None:
+        return job['post_id']
+
+    post = json.loads(job['post'])
+    # Checked before writing any image: the files of a live post share the slug's name
+    if get_post_by_slug(post['slug']) is not None:
+        raise PermanentJobError(f"Slug '{post['slug']}' already exists. Please use a different title or slug.")
+
+    image_url, record = save_upload(job['upload_path'], job['base_name'])
+    save_image_variants(image_url, record)
+
+    success, result = add_new_post(post['title'], post['date'], post['author'], post['content'],
+                                   image_url, post['slug'], image_job_id=job['id'])
+    if not success:
+        raise PermanentJobError(result)
+    return result
+
+
+def process_next() -> bool:
+    """Run one due job if there is one, returns whether a job was run"""
+    job = claim_job()
+    if job is None:
+        return False
+    try:
+        post_id = run_job(job)
+    except Exception as e:
+        retry = not isinstance(e, PermanentJobError) and job['attempts'] < IMAGE_JOB_MAX_ATTEMPTS
+        print(f"Image job {job['id']} attempt {job['attempts']} failed: {e}")
+        if retry:
+            delay = IMAGE_JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+            _update(job['id'], status='pending', error=str(e), run_after=_now() + delay)
+        else:
+            _update(job['id'], status='failed', error=str(e))
+            _remove_upload(job)
+        return True
+    _update(job['id'], status='done', error=None, post_id=post_id)
+    _remove_upload(job)
+    return True
+
+
+def _remove_upload(job):
+    try:
+        os.remove(job['upload_path'])
+    except OSError:
+        pass
+
+
+def work(stop=None):
+    """Drain the queue until stop (a threading.Event) is set"""
+    while stop is None or not stop.is_set():
+        try:
+            if process_next():
+                continue
+        except Exception as e:
+            print(f"Image worker error: {e}")
+        _wakeup.wait(IMAGE_JOB_POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_workers(count: int = None):
+    """Ensure this process runs at least count (default IMAGE_WORKER_THREADS) daemon worker threads"""
+    global _workers_pid
+    if count is None:
+        # Read per call: manage.py image-worker sets it to 0 before importing the app
+        count = int(os.getenv('IMAGE_WORKER_THREADS', '1'))
+    with _workers_lock:
+        if _workers_pid != os.getpid():
+            _workers.clear()
+            _workers_pid = os.getpid()
+        while len(_workers) < count:
+            thread = threading.Thread(target=work, name=f"image-worker-{len(_workers) + 1}", daemon=True)
+            thread.start()
+            _workers.append(thread)
+    return list(_workers)
@@ -0,0 +1,453 @@
+"""
+Byte-level EXIF/XMP reader and writer for JPEG, PNG and WebP files.
+
+Metadata is spliced into the container without decoding pixels: JPEG APP1
+segments, PNG eXIf/iTXt chunks and WebP RIFF EXIF/XMP chunks are replaced,
+and everything else (including the compressed image data) is streamed
+through unchanged. scan_image() reads dimensions and metadata the same way,
+from the container headers only.
+"""
+import hashlib, os, re, shutil, struct, zlib
+from xml.sax.saxutils import escape, unescape
+
+
+JPEG_SOI = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_NAMESPACE = b'http://ns.adobe.com/xap/1.0/\x00'
+XMP_PNG_KEYWORD = 'XML:com.adobe.xmp'
+
+# VP8X feature flags
+WEBP_FLAG_ICC, WEBP_FLAG_ALPHA, WEBP_FLAG_EXIF, WEBP_FLAG_XMP, WEBP_FLAG_ANIMATION = 0x20, 0x10, 0x08, 0x04, 0x02
+
+
+def detect_format(header: bytes):
+    """'jpeg', 'png', 'webp' or None from the first 12 bytes of a file"""
+    if header.startswith(JPEG_SOI):
+        return 'jpeg'
+    if header.startswith(PNG_SIGNATURE):
+        return 'png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def build_xmp(title: str, description: str, keywords) -> bytes:
+    """Minimal XMP packet with Dublin Core title, description and subject"""
+    subjects = ''.join(f"<rdf:li>{escape(k)}</rdf:li>" for k in keywords)
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{escape(title)}</rdf:li></rdf:Alt></dc:title>'
+        f'<dc:description><rdf:Alt><rdf:li xml:lang="x-default">{escape(description)}</rdf:li></rdf:Alt></dc:description>'
+        f'<dc:subject><rdf:Bag>{subjects}</rdf:Bag></dc:subject>'
+        '</rdf:Description></rdf:RDF></x:xmpmeta>'
+        '<?xpacket end="w"?>'
+    ).encode('utf-8')
+
+
+def _copy(src, dst, length: int):
+    """Copy exactly length bytes from src to dst"""
+    while length:
+        chunk = src.read(min(length, 1024 * 1024))
+        if not chunk:
+            raise ValueError("Unexpected end of file")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+# JPEG
+
+def iter_jpeg_segments(f):
+    """
+    Yield (marker, payload) for each header segment of a JPEG opened at offset 0
+    (payload is None for standalone markers). Stops before the start of scan,
+    leaving f positioned on its marker.
+    """
+    if f.read(2) != JPEG_SOI:
+        raise ValueError("Not a JPEG file")
+    while True:
+        position = f.tell()
+        if f.read(1) != b'\xff':
+            raise ValueError(f"Corrupt JPEG segment at offset {position}")
+        marker = f.read(1)
+        while marker == b'\xff':  # fill bytes
+            marker = f.read(1)
+        if not marker:
+            raise ValueError("Unexpected end of file")
+        marker = marker[0]
+        if marker in (0xDA, 0xD9):  # SOS / EOI: entropy-coded data follows
+            f.seek(position)
+            return
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # standalone markers
+            yield marker, None
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        yield marker, f.read(length - 2)
+
+
+def _is_jpeg_exif(marker, payload):
+    return marker == 0xE1 and payload.startswith(EXIF_HEADER)
+
+
+def _is_jpeg_xmp(marker, payload):
+    return marker == 0xE1 and payload.startswith(XMP_NAMESPACE)
+
+
+def _jpeg_segment(marker: int, payload: bytes) -> bytes:
+    if payload is None:
+        return b'\xff' + bytes([marker])
+    if len(payload) > 65533:
+        raise ValueError(f"Segment too large for JPEG ({len(payload)} bytes)")
+    return b'\xff' + bytes([marker]) + struct.pack('>H', len(payload) + 2) + payload
+
+
+def write_jpeg_metadata(src, dst, exif: bytes = None, xmp: bytes = None):
+    segments = list(iter_jpeg_segments(src))
+    dst.write(JPEG_SOI)
+    # JFIF (APP0) stays first; the new APP1 segments follow it
+    while segments and segments[0][0] == 0xE0:
+        dst.write(_jpeg_segment(*segments.pop(0)))
+    if exif is not None:
+        dst.write(_jpeg_segment(0xE1, EXIF_HEADER + exif))
+    if xmp is not None:
+        dst.write(_jpeg_segment(0xE1, XMP_NAMESPACE + xmp))
+    for marker, payload in segments:
+        if payload is None:
+            dst.write(_jpeg_segment(marker, None))
+            continue
+        if (exif is not None and _is_jpeg_exif(marker, payload)) or (xmp is not None and _is_jpeg_xmp(marker, payload)):
+            continue
+        dst.write(_jpeg_segment(marker, payload))
+    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+# PNG
+
+def iter_png_chunks(f):
+    """
+    Yield (type, length, offset of data) for each chunk of a PNG opened at offset 0.
+    The caller may read the data; f is moved past it before the next chunk.
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack('>I4s', header)
+        offset = f.tell()
+        yield chunk_type.decode('latin-1'), length, offset
+        f.seek(offset + length + 4)  # data + CRC
+        if chunk_type == b'IEND':
+            return
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def png_itxt(keyword: str, text: str) -> bytes:
+    """Uncompressed iTXt chunk without language tag"""
+    # keyword NUL, compression flag, compression method, language NUL, translated keyword NUL, text
+    data = keyword.encode('latin-1') + b'\x00' + b'\x00\x00' + b'\x00' + b'\x00' + text.encode('utf-8')
+    return _png_chunk(b'iTXt', data)
+
+
+def png_text_keyword(f, length: int):
+    """Keyword of a tEXt/zTXt/iTXt chunk whose data f is positioned on"""
+    return f.read(min(length, 80)).split(b'\x00', 1)[0].decode('latin-1')
+
+
+def write_png_metadata(src, dst, exif: bytes = None, xmp: bytes = None, text: dict = None):
+    text = text or {}
+    replaced = set(text) | ({XMP_PNG_KEYWORD} if xmp is not None else set())
+    new_chunks = b''
+    if exif is not None:
+        new_chunks += _png_chunk(b'eXIf', exif)
+    if xmp is not None:
+        new_chunks += png_itxt(XMP_PNG_KEYWORD, xmp.decode('utf-8'))
+    for keyword, value in text.items():
+        new_chunks += png_itxt(keyword, value)
+
+    chunks = list(iter_png_chunks(src))
+    dst.write(PNG_SIGNATURE)
+    written = False
+    for chunk_type, length, offset in chunks:
+        if chunk_type == 'eXIf' and exif is not None:
+            continue
+        if chunk_type in ('tEXt', 'zTXt', 'iTXt'):
+            src.seek(offset)
+            if png_text_keyword(src, length) in replaced:
+                continue
+        if not written and chunk_type in ('IDAT', 'IEND'):
+            # eXIf has to precede the image data
+            dst.write(new_chunks)
+            written = True
+        src.seek(offset - 8)
+        _copy(src, dst, length + 12)
+
+
+# WebP
+
+def iter_webp_chunks(f):
+    """Yield (fourcc, size, offset of data) for each chunk of a WebP opened at offset 0"""
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WEBP':
+        raise ValueError("Not a WebP file")
+    riff_end = 8 + struct.unpack('<I', header[4:8])[0]
+    position = 12
+    while position + 8 <= riff_end:
+        f.seek(position)
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            return
+        fourcc, size = struct.unpack('<4sI', chunk_header)
+        yield fourcc.decode('latin-1'), size, position + 8
+        position += 8 + size + (size & 1)
+
+
+def webp_canvas(f, fourcc: str, size: int, offset: int):
+    """(width, height, has_alpha) from the first chunk of a WebP"""
+    f.seek(offset)
+    data = f.read(min(size, 30))
+    if fourcc == 'VP8X':
+        width = 1 + int.from_bytes(data[4:7], 'little')
+        height = 1 + int.from_bytes(data[7:10], 'little')
+        return width, height, bool(data[0] & WEBP_FLAG_ALPHA)
+    if fourcc == 'VP8 ':
+        if data[3:6] != b'\x9d\x01\x2a':
+            raise ValueError("Corrupt VP8 header")
+        width, height = struct.unpack('<HH', data[6:10])
+        return width & 0x3FFF, height & 0x3FFF, False
+    if fourcc == 'VP8L':
+        if data[0] != 0x2F:
+            raise ValueError("Corrupt VP8L header")
+        bits = struct.unpack('<I', data[1:5])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, bool((bits >> 28) & 1)
+    raise ValueError(f"Unexpected first WebP chunk {fourcc!r}")
+
+
+def _webp_chunk_header(fourcc: bytes, size: int) -> bytes:
+    return fourcc + struct.pack('<I', size)
+
+
+def write_webp_metadata(src, dst, exif: bytes = None, xmp: bytes = None):
+    chunks = list(iter_webp_chunks(src))
+    if not chunks:
+        raise ValueError("Empty WebP file")
+    dropped = ({'EXIF'} if exif is not None else set()) | ({'XMP '} if xmp is not None else set())
+    kept = [c for c in chunks if c[0] not in dropped and c[0] != 'VP8X']
+
+    # Simple (VP8/VP8L only) files gain a VP8X header announcing the metadata
+    first = chunks[0]
+    if first[0] == 'VP8X':
+        src.seek(first[2])
+        vp8x = bytearray(src.read(first[1]))
+    else:
+        width, height, alpha = webp_canvas(src, *first)
+        vp8x = bytearray(10)
+        vp8x[0] = WEBP_FLAG_ALPHA if alpha else 0
+        vp8x[4:7] = (width - 1).to_bytes(3, 'little')
+        vp8x[7:10] = (height - 1).to_bytes(3, 'little')
+    if exif is not None:
+        vp8x[0] |= WEBP_FLAG_EXIF
+    if xmp is not None:
+        vp8x[0] |= WEBP_FLAG_XMP
+    vp8x = bytes(vp8x)
+
+    appended = [(b'EXIF', exif), (b'XMP ', xmp)]
+    appended = [(fourcc, data) for fourcc, data in appended if data is not None]
+    riff_size = 4 + (8 + len(vp8x) + (len(vp8x) & 1))
+    riff_size += sum(8 + size + (size & 1) for _, size, _ in kept)
+    riff_size += sum(8 + len(data) + (len(data) & 1) for _, data in appended)
+
+    dst.write(b'RIFF' + struct.pack('<I', riff_size) + b'WEBP')
+    dst.write(_webp_chunk_header(b'VP8X', len(vp8x)) + vp8x + b'\x00' * (len(vp8x) & 1))
+    for fourcc, size, offset in kept:
+        src.seek(offset - 8)
+        _copy(src, dst, 8 + size)
+        if size & 1:
+            dst.write(b'\x00')
+    # EXIF and XMP come after the image data
+    for fourcc, data in appended:
+        dst.write(_webp_chunk_header(fourcc, len(data)) + data + b'\x00' * (len(data) & 1))
+
+
+def read_exif(path) -> bytes:
+    """Existing EXIF (TIFF bytes, without the JPEG 'Exif' header) or None, read from headers only"""
+    with open(path, 'rb') as f:
+        kind = detect_format(f.read(12))
+        f.seek(0)
+        if kind == 'jpeg':
+            for marker, payload in iter_jpeg_segments(f):
+                if _is_jpeg_exif(marker, payload):
+                    return payload[len(EXIF_HEADER):]
+        elif kind == 'png':
+            for chunk_type, length, offset in iter_png_chunks(f):
+                if chunk_type == 'eXIf':
+                    return f.read(length)
+                if chunk_type == 'IDAT':
+                    break
+        elif kind == 'webp':
+            for fourcc, size, offset in iter_webp_chunks(f):
+                if fourcc == 'EXIF':
+                    f.seek(offset)
+                    data = f.read(size)
+                    # Some encoders keep the JPEG-style header
+                    return data[len(EXIF_HEADER):] if data.startswith(EXIF_HEADER) else data
+    return None
+
+
+def write_metadata(src_path, dst_path, exif: bytes = None, xmp: bytes = None, text: dict = None):
+    """
+    Copy src_path to dst_path with its EXIF/XMP replaced (None leaves that block as is).
+    text adds iTXt entries for PNG files, which other formats ignore.
+    """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        kind = detect_format(src.read(12))
+        src.seek(0)
+        if kind == 'jpeg':
+            write_jpeg_metadata(src, dst, exif, xmp)
+        elif kind == 'png':
+            write_png_metadata(src, dst, exif, xmp, text)
+        elif kind == 'webp':
+            write_webp_metadata(src, dst, exif, xmp)
+        else:
+            raise ValueError(f"Unsupported image format: {src_path}")
+
+
+def pixel_digest(path) -> str:
+    """Hash of the decoded pixels (every frame), used to check metadata edits are lossless"""
+    from PIL import Image, ImageSequence
+    digest = hashlib.blake2b(digest_size=16)
+    with Image.open(path) as img:
+        for frame in ImageSequence.Iterator(img):
+            digest.update(f"{frame.mode}{frame.size}".encode('ascii'))
+            digest.update(frame.tobytes())
+    return digest.hexdigest()
+
+
+# Header-only scanning
+
+def _decode_exif_text(value):
+    if isinstance(value, bytes):
+        for encoding in ('utf-8', 'utf-16le'):
+            try:
+                return value.decode(encoding).rstrip('\x00')
+            except UnicodeDecodeError:
+                continue
+        return None
+    if isinstance(value, tuple):  # XP* tags as a tuple of byte values
+        return bytes(value).decode('utf-16le', errors='replace').rstrip('\x00')
+    return value
+
+
+def parse_exif(exif: bytes) -> dict:
+    """Title/description/keywords/datetime from EXIF TIFF bytes"""
+    import piexif
+    try:
+        ifd = piexif.load(exif).get('0th', {})
+    except Exception:
+        return {}
+    fields = {
+        'title': ifd.get(piexif.ImageIFD.XPTitle),
+        'description': ifd.get(piexif.ImageIFD.ImageDescription),
+        'keywords': ifd.get(piexif.ImageIFD.XPKeywords),
+        'datetime': ifd.get(piexif.ImageIFD.DateTime),
+    }
+    return {k: _decode_exif_text(v) for k, v in fields.items() if v is not None}
+
+
+def parse_xmp(xmp: bytes) -> dict:
+    """Title/description/keywords from the Dublin Core fields of an XMP packet"""
+    text = xmp.decode('utf-8', errors='replace')
+    fields = {}
+    for name in ('title', 'description'):
+        match = re.search(rf'<dc:{name}>.*?<rdf:li[^>]*>(.*?)</rdf:li>', text, re.S)
+        if match:
+            fields[name] = unescape(match.group(1))
+    subject = re.search(r'<dc:subject>(.*?)</dc:subject>', text, re.S)
+    if subject:
+        fields['keywords'] = ', '.join(unescape(k) for k in re.findall(r'<rdf:li[^>]*>(.*?)</rdf:li>', subject.group(1), re.S))
+    return fields
+
+
+def _scan_jpeg(f, info):
+    for marker, payload in iter_jpeg_segments(f):
+        if payload is None:
+            continue
+        # SOFn (except DHT/JPG/DAC) carries the frame size
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC) and 'width' not in info:
+            info['height'], info['width'] = struct.unpack('>HH', payload[1:5])
+        elif _is_jpeg_exif(marker, payload):
+            info['exif'] = payload[len(EXIF_HEADER):]
+        elif _is_jpeg_xmp(marker, payload):
+            info['xmp'] = payload[len(XMP_NAMESPACE):]
+
+
+def _scan_png(f, info):
+    for chunk_type, length, offset in iter_png_chunks(f):
+        if chunk_type == 'IHDR':
+            info['width'], info['height'] = struct.unpack('>II', f.read(8))
+        elif chunk_type == 'eXIf':
+            info['exif'] = f.read(length)
+        elif chunk_type in ('tEXt', 'iTXt'):
+            data = f.read(length)
+            keyword, _, rest = data.partition(b'\x00')
+            if chunk_type == 'iTXt':
+                if rest[:1] != b'\x00':  # compressed iTXt, not worth inflating here
+                    continue
+                rest = rest[2:].split(b'\x00', 2)[-1]
+            keyword = keyword.decode('latin-1')
+            if keyword == XMP_PNG_KEYWORD:
+                info['xmp'] = rest
+            else:
+                info['text'][keyword] = rest.decode('utf-8' if chunk_type == 'iTXt' else 'latin-1', errors='replace')
+
+
+def _scan_webp(f, info):
+    for index, (fourcc, size, offset) in enumerate(iter_webp_chunks(f)):
+        if index == 0:
+            info['width'], info['height'], _ = webp_canvas(f, fourcc, size, offset)
+        elif fourcc in ('EXIF', 'XMP '):
+            f.seek(offset)
+            data = f.read(size)
+            if fourcc == 'EXIF':
+                info['exif'] = data[len(EXIF_HEADER):] if data.startswith(EXIF_HEADER) else data
+            else:
+                info['xmp'] = data
+
+
+def scan_image(path) -> dict:
+    """
+    Format, dimensions, size and metadata of an image, parsed from its
+    container headers only (pixel data is never read)
+    """
+    result = {'path': str(path), 'format': None, 'width': None, 'height': None,
+              'bytes': os.path.getsize(path), 'title': None, 'description': None,
+              'keywords': None, 'datetime': None, 'has_exif': False, 'has_xmp': False, 'error': None}
+    info = {'text': {}}
+    try:
+        with open(path, 'rb') as f:
+            kind = detect_format(f.read(12))
+            f.seek(0)
+            result['format'] = kind
+            scanner = {'jpeg': _scan_jpeg, 'png': _scan_png, 'webp': _scan_webp}.get(kind)
+            if scanner is None:
+                raise ValueError("Unsupported image format")
+            scanner(f, info)
+    except (OSError, ValueError, struct.error) as e:
+        result['error'] = str(e)
+
+    result['width'], result['height'] = info.get('width'), info.get('height')
+    result['has_exif'], result['has_xmp'] = 'exif' in info, 'xmp' in info
+    # EXIF wins, then XMP, then PNG text chunks
+    sources = [parse_exif(info['exif']) if 'exif' in info else {},
+               parse_xmp(info['xmp']) if 'xmp' in info else {},
+               {k.lower(): v for k, v in info['text'].items()}]
+    for field in ('title', 'description', 'keywords', 'datetime'):
+        result[field] = next((s[field] for s in sources if s.get(field)), None)
+    return result
@@ -0,0 +1,195 @@
+"""
+On-demand resized copies of static/img files for the /img/<width>/<name> route.
+
+The first request for a width/format encodes the image and writes it
+atomically into IMAGE_CACHE_DIR; later requests are served from that file.
+Concurrent misses for the same file wait on one encode (a thread lock inside
+the process plus an flock across gunicorn workers). The directory is kept
+under IMAGE_CACHE_MAX_BYTES by evicting the least recently served files.
+"""
+import fcntl, hashlib, os, threading, time
+from PIL import Image
+from functions.images import STATIC_IMG_DIR, RESPONSIVE_WIDTHS, IMAGE_FORMATS, flatten_to_rgb
+
+
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'cache', 'img'))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# Only these widths are generated, so the cache can't be filled with arbitrary sizes
+ALLOWED_WIDTHS = RESPONSIVE_WIDTHS
+
+# Encodings for clients that accept neither AVIF nor WebP
+FALLBACK_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'image/png', {'optimize': True}),
+}
+
+# Cross-process locks are striped over this many files (never deleted)
+LOCK_STRIPES = 64
+
+# Hits only refresh a file's mtime (its LRU position) once per interval
+TOUCH_INTERVAL = 60
+
+_key_locks = {}
+_key_locks_guard = threading.Lock()
+_size_lock = threading.Lock()
+_cache_bytes = None
+
+
+def output_formats():
+    """Every format the resizer can produce: format -> (PIL format, mimetype, save options)"""
+    return {**IMAGE_FORMATS, **FALLBACK_FORMATS}
+
+
+def choose_format(accept_mimetypes, source_name: str) -> str:
+    """AVIF or WebP when the client accepts them, else the source's own family"""
+    # Only explicit mentions count: image/* doesn't mean the browser decodes AVIF
+    accepted = {value for value, quality in accept_mimetypes if quality > 0}
+    for fmt, (_, mimetype, _) in IMAGE_FORMATS.items():
+        if mimetype in accepted:
+            return fmt
+    return 'jpeg' if source_name.lower().endswith(('.jpg', '.jpeg')) else 'png'
+
+
+def _cache_path(source_path, width, fmt):
+    stat = os.stat(source_path)
+    # Source size/mtime are part of the key, so a replaced image gets new entries
+    key = f"{source_path}|{stat.st_size}|{stat.st_mtime_ns}|{width}|{fmt}"
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+    return os.path.join(IMAGE_CACHE_DIR, digest[:2], f"{digest}.{fmt}")
+
+
+def _key_lock(key):
+    with _key_locks_guard:
+        lock = _key_locks.get(key)
+        if lock is None:
+            lock = _key_locks[key] = [threading.Lock(), 0]
+        lock[1] += 1
+        return lock
+
+
+def _release_key_lock(key, lock):
+    with _key_locks_guard:
+        lock[1] -= 1
+        if lock[1] == 0:
+            _key_locks.pop(key, None)
+
+
+def _lock_file_path(target):
+    stripe = int(os.path.basename(target)[:8], 16) % LOCK_STRIPES
+    lock_dir = os.path.join(IMAGE_CACHE_DIR, 'locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, f"{stripe}.lock")
+
+
+def _encode(source_path, target, width, fmt):
+    pil_format, _, options = output_formats()[fmt]
+    with Image.open(source_path) as img:
+        img.draft('RGB', (width, width))  # lets JPEG decode at a reduced scale
+        img = flatten_to_rgb(img)
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS, reducing_gap=3.0)
+        tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            img.save(tmp, pil_format, **options)
+            os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def _touch(path, mtime):
+    now = time.time()
+    if now - mtime > TOUCH_INTERVAL:
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+
+
+def get_resized(name: str, width: int, fmt: str):
+    """
+    Path of the cached width/format rendition of static/img/<name>, encoding it
+    on first use. Returns None when the source doesn't exist.
+    """
+    source_path = os.path.realpath(os.path.join(STATIC_IMG_DIR, name))
+    if not source_path.startswith(os.path.realpath(STATIC_IMG_DIR) + os.sep) or not os.path.isfile(source_path):
+        return None
+    target = _cache_path(source_path, width, fmt)
+
+    try:
+        _touch(target, os.stat(target).st_mtime)
+        return target
+    except FileNotFoundError:
+        pass
+
+    # Single flight: one thread per process, then one process per host
+    lock = _key_lock(target)
+    try:
+        with lock[0]:
+            if os.path.exists(target):
+                return target
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(_lock_file_path(target), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(target):
+                        _encode(source_path, target, width, fmt)
+                        _added(os.path.getsize(target))
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        _release_key_lock(target, lock)
+    return target
+
+
+def _scan():
+    """(path, size, mtime) of every cached file"""
+    entries = []
+    for root, dirs, files in os.walk(IMAGE_CACHE_DIR):
+        if 'locks' in dirs:
+            dirs.remove('locks')
+        for filename in files:
+            if filename.endswith(('.lock', '.tmp')):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def _added(nbytes):
+    global _cache_bytes
+    with _size_lock:
+        if _cache_bytes is None:
+            # First write in this process: the scan already includes the new file
+            _cache_bytes = sum(size for _, size, _ in _scan())
+        else:
+            _cache_bytes += nbytes
+        over = _cache_bytes > IMAGE_CACHE_MAX_BYTES
+    if over:
+        evict()
+
+
+def evict(target_bytes=None):
+    """Delete least recently served files until the cache is under target_bytes (90% of the cap)"""
+    global _cache_bytes
+    if target_bytes is None:
+        target_bytes = int(IMAGE_CACHE_MAX_BYTES * 0.9)
+    with _size_lock:
+        # Rescan: other workers add files too
+        entries = sorted(_scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        _cache_bytes = total
+    return total
@@ -0,0 +1,137 @@
+"""
+Responsive derivatives of uploaded and library images.
+
+Every source image is resized to the RESPONSIVE_WIDTHS narrower than itself
+(never upscaled) and encoded as AVIF and WebP under static/img/responsive/,
+one directory per source file. The resulting variants are recorded in the
+images table (see database.save_image_variants) together with a tiny inline
+placeholder and the dominant colour, and the post store turns them into
+srcset strings and background styles for the templates.
+"""
+import base64, io, json, os
+from urllib.parse import quote
+from PIL import Image, ImageOps, features
+
+
+STATIC_IMG_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'img')
+RESPONSIVE_DIR = os.path.join(STATIC_IMG_DIR, 'responsive')
+STATIC_IMG_URL = '/static/img'
+
+RESPONSIVE_WIDTHS = (320, 640, 1024, 1600)
+
+# format -> (PIL format, mimetype, save options). AVIF comes first because the
+# browser takes the first <source> type it supports
+IMAGE_FORMATS = {
+    'avif': ('AVIF', 'image/avif', {'quality': 55, 'speed': 6}),
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 6}),
+}
+if not features.check('avif'):  # Pillow built without libavif
+    del IMAGE_FORMATS['avif']
+
+# Width of the inline placeholder; the browser's upscaling blurs it
+PLACEHOLDER_WIDTH = 20
+
+# Suffixes the library backfill picks up under static/img
+SOURCE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp', '.tiff')
+
+
+def flatten_to_rgb(img):
+    """Apply EXIF orientation and flatten transparency onto white"""
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def derivative_widths(width: int) -> list:
+    """Configured widths below the source width, plus the source width capped at the largest one"""
+    widths = [w for w in RESPONSIVE_WIDTHS if w < width]
+    widths.append(min(width, RESPONSIVE_WIDTHS[-1]))
+    return sorted(set(widths))
+
+
+def placeholder(img):
+    """(data: URI of a tiny WebP thumbnail, dominant color as '#rrggbb') for an RGB image"""
+    thumb = img.copy()
+    thumb.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH), Image.BOX, reducing_gap=2.0)
+    buffer = io.BytesIO()
+    thumb.save(buffer, 'WEBP', quality=40)
+    data_uri = 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    # Most common colour after reducing the thumbnail to a small palette
+    quantized = thumb.quantize(colors=5, method=Image.Quantize.MEDIANCUT)
+    _, index = max(quantized.getcolors())
+    r, g, b = quantized.getpalette()[index * 3:index * 3 + 3]
+    return data_uri, f"#{r:02x}{g:02x}{b:02x}"
+
+
+def source_url(rel_path: str) -> str:
+    """URL of a file under static/img, as stored in posts.image"""
+    return f"{STATIC_IMG_URL}/{rel_path}"
+
+
+def generate_derivatives(img, rel_path: str) -> dict:
+    """
+    Write every width/format of an RGB image for the source at static/img/<rel_path>,
+    returns {'width', 'height', 'variants': {format: [[width, url], ...]},
+    'placeholder', 'dominant_color'}
+    """
+    out_dir = os.path.join(RESPONSIVE_DIR, rel_path)
+    os.makedirs(out_dir, exist_ok=True)
+    variants = {fmt: [] for fmt in IMAGE_FORMATS}
+
+    for width in derivative_widths(img.width):
+        height = max(1, round(img.height * width / img.width))
+        resized = img if width == img.width else img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        for fmt, (pil_format, _, options) in IMAGE_FORMATS.items():
+            filename = f"{width}w.{fmt}"
+            resized.save(os.path.join(out_dir, filename), pil_format, **options)
+            variants[fmt].append([width, f"{STATIC_IMG_URL}/responsive/{rel_path}/{filename}"])
+
+    data_uri, color = placeholder(img)
+    return {'width': img.width, 'height': img.height, 'variants': variants,
+            'placeholder': data_uri, 'dominant_color': color}
+
+
+def save_upload(stream, base_name: str):
+    """
+    Convert an uploaded image to a full-size WebP plus its derivatives,
+    returns (image URL for posts.image, derivative record)
+    """
+    img = flatten_to_rgb(Image.open(stream))
+    rel_path = f"{base_name}.webp"
+    img.save(os.path.join(STATIC_IMG_DIR, rel_path), 'WEBP', quality=85, optimize=True)
+    return source_url(rel_path), generate_derivatives(img, rel_path)
+
+
+def library_images():
+    """Relative paths of every source image under static/img (derivatives excluded)"""
+    for root, dirs, files in os.walk(STATIC_IMG_DIR):
+        if os.path.abspath(root) == os.path.abspath(STATIC_IMG_DIR) and 'responsive' in dirs:
+            dirs.remove('responsive')
+        for name in sorted(files):
+            if name.lower().endswith(SOURCE_SUFFIXES):
+                yield os.path.relpath(os.path.join(root, name), STATIC_IMG_DIR).replace(os.sep, '/')
+
+
+def build_srcsets(variants_json):
+    """{mimetype: srcset} from the JSON stored in images.variants, None if there is nothing to offer"""
+    if not variants_json:
+        return None
+    try:
+        variants = json.loads(variants_json)
+    except ValueError:
+        return None
+    srcsets = {}
+    for fmt, (_, mimetype, _) in IMAGE_FORMATS.items():
+        entries = variants.get(fmt)
+        if entries:
+            # Quote so spaces or commas in file names can't break the srcset syntax
+            srcsets[mimetype] = ', '.join(f"{quote(url)} {width}w" for width, url in entries)
+    return srcsets or None
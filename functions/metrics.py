@@ -0,0 +1,204 @@
+"""
+Request, SQL and template timings in Prometheus text format.
+
+Each worker process records into in-memory counters and histograms and
+writes them to METRICS_DIR/<pid>.json at most every METRICS_FLUSH_INTERVAL
+seconds. /admin/metrics sums the files of every worker, so the numbers
+cover the whole gunicorn pool. Files of workers that have exited are folded
+into archive.json, so counters never go backwards when a worker is
+replaced.
+
+Kept free of other functions.* imports, since database.py reports into it.
+"""
+import fcntl, json, os, threading, time
+
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'cache', 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name -> (type, help, buckets or None)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests by endpoint, method and status', None),
+    'http_request_duration_seconds': ('histogram', 'Time from before_request to after_request', LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', 'Response body size (after compression)', SIZE_BUCKETS),
+    'sqlite_query_duration_seconds': ('histogram', 'SQLite execute() time by statement type', FAST_BUCKETS),
+    'template_render_duration_seconds': ('histogram', 'Jinja render time by template', FAST_BUCKETS),
+    'write_queue_rejected_total': ('counter', 'Rows refused by a full write queue, by kind', None),
+}
+
+_lock = threading.Lock()
+# (name, labels) -> count for counters, [bucket counts..., +Inf count, sum] for histograms
+_values = {}
+_pid = None
+_flushed_at = 0.0
+
+
+def _labels_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def _reset_after_fork():
+    """A forked worker starts from zero (the parent's numbers are in its own file)"""
+    global _pid, _flushed_at
+    if _pid != os.getpid():
+        _values.clear()
+        _pid = os.getpid()
+        _flushed_at = time.monotonic()
+
+
+def inc(name: str, labels: dict, amount: float = 1):
+    with _lock:
+        _reset_after_fork()
+        key = (name, _labels_key(labels))
+        _values[key] = _values.get(key, 0) + amount
+    _maybe_flush()
+
+
+def observe(name: str, labels: dict, value: float):
+    buckets = METRICS[name][2]
+    with _lock:
+        _reset_after_fork()
+        key = (name, _labels_key(labels))
+        slots = _values.get(key)
+        if slots is None:
+            slots = _values[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                slots[i] += 1
+                break
+        else:
+            slots[len(buckets)] += 1
+        slots[-1] += value
+    _maybe_flush()
+
+
+def _snapshot():
+    return [[name, list(labels), value] for (name, labels), value in _values.items()]
+
+
+def _merge(into: dict, entries):
+    for name, labels, value in entries:
+        if name not in METRICS:
+            continue
+        key = (name, tuple(tuple(pair) for pair in labels))
+        current = into.get(key)
+        if current is None:
+            into[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            into[key] = [a + b for a, b in zip(current, value)]
+        else:
+            into[key] = current + value
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def flush():
+    """Write this worker's numbers to its file"""
+    global _flushed_at
+    with _lock:
+        _reset_after_fork()
+        data = _snapshot()
+        _flushed_at = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), data)
+
+
+def _maybe_flush():
+    if time.monotonic() - _flushed_at >= METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except OSError as e:
+            print(f"Writing metrics failed: {e}")
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def collect() -> dict:
+    """Sum of every worker's numbers, exited workers folded into archive.json"""
+    flush()
+    totals = {}
+    with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            archive_path = os.path.join(METRICS_DIR, 'archive.json')
+            archive = {}
+            _merge(archive, _read(archive_path))
+            dead = []
+            for name in os.listdir(METRICS_DIR):
+                pid = name[:-len('.json')]
+                if not (name.endswith('.json') and pid.isdigit()):
+                    continue
+                entries = _read(os.path.join(METRICS_DIR, name))
+                if _alive(int(pid)):
+                    _merge(totals, entries)
+                else:
+                    _merge(archive, entries)
+                    dead.append(name)
+            if dead:
+                _write_json(archive_path, [[name, list(labels), value] for (name, labels), value in archive.items()])
+                for name in dead:
+                    os.remove(os.path.join(METRICS_DIR, name))
+            _merge(totals, [[name, list(labels), value] for (name, labels), value in archive.items()])
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return totals
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(totals: dict) -> str:
+    """Prometheus text exposition (version 0.0.4) of collect()'s result"""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in totals.items() if metric == name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip((*buckets, '+Inf'), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,212 @@
+"""
+Bounded cache of fully rendered pages.
+
+Entries hold the rendered body together with its compressed variants (gzip,
+and brotli when available), so a page is rendered and compressed once and then
+served many times. The cache is an
+LRU bounded by the total bytes stored; entries can carry a TTL (for pages with
+randomized content) and tags, which add_new_post invalidates by name.
+
+Given a shared cache backend, the LRU acts as a first level in front of it: a
+page rendered by one gunicorn worker is stored there and picked up by the
+others, and version mismatches (see post_store) invalidate it everywhere.
+Shared keys carry a deploy id (see deploy_id), so pages rendered by an older
+deploy are never served after templates, translations, code or the asset
+manifest change; their rows age out of the shared cache.
+"""
+import hashlib, json, os, threading, time
+from datetime import datetime, timezone
+from collections import OrderedDict
+from functions.compression import compress_variants
+
+
+def make_etag(body: bytes, version=None) -> str:
+    """Strong validator for a body rendered from a given data version"""
+    digest = hashlib.blake2b(body, digest_size=16)
+    digest.update(str(version).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def deploy_id(manifest_path, *paths) -> str:
+    """
+    Short hash of the asset manifest's content and the mtimes of every file
+    under paths (templates, translations, code). The same in every worker
+    started from the same tree, different after a deploy.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    try:
+        with open(manifest_path, 'rb') as f:
+            digest.update(f.read())
+    except OSError:
+        pass  # no build_assets.py run yet
+    for path in paths:
+        walk = os.walk(path) if os.path.isdir(path) else [(os.path.dirname(path), [], [os.path.basename(path)])]
+        for root, dirs, files in sorted(walk):
+            if '__pycache__' in root:
+                continue  # compiled by whichever worker imports first
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                try:
+                    digest.update(f"{file_path}:{os.stat(file_path).st_mtime_ns}\n".encode('utf-8'))
+                except OSError:
+                    pass
+    return digest.hexdigest()
+
+
+class CachedPage:
+    """A rendered response body plus the metadata needed to replay it"""
+    __slots__ = ('body', 'variants', 'status', 'mimetype', 'created_at', 'expires_at', 'tags', 'version',
+                 'etag', 'last_modified')
+
+    def __init__(self, body: bytes, status=200, mimetype='text/html', ttl=None, tags=(), version=None,
+                 last_modified=None):
+        self.body = body
+        # Compressed copies keyed by Content-Encoding ('gzip', 'br')
+        self.variants = compress_variants(body) if body else {}
+        self.status = status
+        self.mimetype = mimetype
+        self.created_at = time.time()
+        self.expires_at = self.created_at + ttl if ttl else None
+        self.tags = frozenset(tags)
+        # Version of the data the page was rendered from (e.g. the post snapshot)
+        self.version = version
+        self.etag = make_etag(body, version)
+        self.last_modified = last_modified
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(v) for v in self.variants.values())
+
+    def is_expired(self, now=None) -> bool:
+        return self.expires_at is not None and (now or time.time()) >= self.expires_at
+
+    def to_bytes(self) -> bytes:
+        """Serialize as a JSON header line followed by the body and its variants"""
+        header = json.dumps({
+            'status': self.status, 'mimetype': self.mimetype, 'created_at': self.created_at,
+            'expires_at': self.expires_at, 'tags': sorted(self.tags), 'version': self.version,
+            'etag': self.etag, 'body_length': len(self.body),
+            'variants': [[encoding, len(data)] for encoding, data in self.variants.items()],
+            'last_modified': self.last_modified.timestamp() if self.last_modified else None,
+        }).encode('utf-8')
+        return b''.join([header, b'\n', self.body, *self.variants.values()])
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        header, _, payload = data.partition(b'\n')
+        meta = json.loads(header)
+        entry = cls.__new__(cls)
+        offset = meta['body_length']
+        entry.body = payload[:offset]
+        entry.variants = {}
+        for encoding, length in meta['variants']:
+            entry.variants[encoding] = payload[offset:offset + length]
+            offset += length
+        entry.status = meta['status']
+        entry.mimetype = meta['mimetype']
+        entry.created_at = meta['created_at']
+        entry.expires_at = meta['expires_at']
+        entry.tags = frozenset(meta['tags'])
+        entry.version = meta['version']
+        entry.etag = meta['etag']
+        entry.last_modified = (datetime.fromtimestamp(meta['last_modified'], timezone.utc)
+                               if meta['last_modified'] is not None else None)
+        return entry
+
+
+class PageCache:
+    """Thread-safe LRU of CachedPage entries, bounded by total bytes"""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, shared=None, namespace=''):
+        self.max_bytes = max_bytes
+        # Optional CacheBackend used as a second level shared between workers
+        self.shared = shared
+        # Prefix of shared keys, e.g. deploy_id(), so another deploy's pages don't match
+        self.namespace = namespace
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, version=None):
+        """Entry for key, unless it is missing, expired or rendered from another version"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not entry.is_expired() and entry.version == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                self._remove(key)
+
+        entry = self._get_shared(key, version)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._store_local(key, entry)
+        return entry
+
+    def set(self, key: str, entry: CachedPage):
+        self._store_local(key, entry)
+        if self.shared is not None:
+            ttl = entry.expires_at - time.time() if entry.expires_at else None
+            self.shared.set(self._shared_key(key), entry.to_bytes(), ttl=ttl)
+
+    def _shared_key(self, key):
+        return f"page:{self.namespace}:{key}"
+
+    def _get_shared(self, key, version):
+        if self.shared is None:
+            return None
+        data = self.shared.get(self._shared_key(key))
+        if data is None:
+            return None
+        try:
+            entry = CachedPage.from_bytes(data)
+        except (ValueError, KeyError) as e:
+            print(f"Discarding unreadable cached page {key}: {e}")
+            return None
+        if entry.is_expired() or entry.version != version:
+            return None
+        return entry
+
+    def _store_local(self, key, entry):
+        # Pages larger than the whole budget would just evict everything else
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.current_bytes += entry.size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, *tags) -> int:
+        """
+        Drop every local entry carrying any of the given tags, returns the number
+        removed. Shared copies are left to expire; bump the version they were
+        rendered from to invalidate them in every worker.
+        """
+        tags = set(tags)
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if e.tags & tags]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry.size
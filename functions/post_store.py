@@ -0,0 +1,168 @@
+"""
+In-process snapshot of the posts table.
+
+Posts only change through add_new_post(), so page views read from an immutable
+snapshot instead of querying SQLite. Publishing bumps a posts version counter
+in the shared cache backend and rebuilds the snapshot in this worker; other
+gunicorn workers compare that counter at most once per
+POST_STORE_CHECK_INTERVAL seconds. Commits made outside the app (sqlite3
+shell, scripts) are still caught through PRAGMA data_version.
+"""
+import os, threading, time
+from types import MappingProxyType
+from functions.database import open_connection, on_posts_changed, build_page_range, sample_ids, parse_created_at
+from functions.cache_backend import get_cache
+from functions.images import build_srcsets
+
+
+# Seconds between version checks for posts published by other workers
+POST_STORE_CHECK_INTERVAL = float(os.getenv('POST_STORE_CHECK_INTERVAL', '1.0'))
+
+# Counter in the shared cache backend, bumped whenever posts change
+POSTS_VERSION_KEY = 'posts'
+
+
+class PostSnapshot:
+    """Immutable set of posts, ordered newest first and indexed by slug and id"""
+    __slots__ = ('version', 'posts', 'by_slug', 'by_id', 'ids', 'fingerprint')
+
+    def __init__(self, rows, version):
+        # Shared posts version the snapshot was loaded at, comparable across workers
+        self.version = version
+        # Read-only mappings: the same objects are shared by every request
+        self.posts = tuple(MappingProxyType(_with_srcsets(dict(r))) for r in rows)
+        self.by_slug = MappingProxyType({p['slug']: p for p in self.posts if p['slug']})
+        self.by_id = MappingProxyType({p['id']: p for p in self.posts})
+        self.ids = tuple(p['id'] for p in self.posts)
+        self.fingerprint = _fingerprint(self.posts)
+
+
+def _with_srcsets(post):
+    """Replace the joined images.variants JSON with {mimetype: srcset} for the templates"""
+    post['image_srcsets'] = build_srcsets(post.pop('image_variants', None))
+    return post
+
+
+def post_created_at(post):
+    """Publish time of a post as an aware datetime (created_at is stored as UTC text)"""
+    return parse_created_at(post['created_at'])
+
+
+def _fingerprint(posts):
+    return (len(posts),
+            max((p['id'] for p in posts), default=None),
+            max((p['created_at'] or '' for p in posts), default=None))
+
+
+_lock = threading.Lock()
+_snapshot = None
+_checked_at = 0.0
+# Dedicated connection: data_version values are only comparable on the same connection
+_conn = None
+_conn_pid = None
+_data_version = None
+
+
+def _version_connection():
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+        # Shared by request and image worker threads, always under _lock
+        _conn = open_connection(check_same_thread=False)
+        _conn_pid = os.getpid()
+    return _conn
+
+
+def bump_posts_version() -> int:
+    """Tell every worker that posts changed (publish, backfill, manual edits)"""
+    return get_cache().incr(POSTS_VERSION_KEY)
+
+
+def _rebuild(conn, version):
+    """Load every post into a new snapshot and swap it in (caller holds _lock)"""
+    global _snapshot, _data_version, _checked_at
+    # Read data_version first so a commit landing mid-load is picked up next check
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    rows = conn.execute("""
+        SELECT posts.*, images.variants AS image_variants,
+               images.placeholder AS image_placeholder, images.dominant_color AS image_color
+        FROM posts LEFT JOIN images ON images.path = posts.image
+        ORDER BY posts.id DESC
+    """).fetchall()
+    _snapshot = PostSnapshot(rows, version)
+    _data_version = data_version
+    _checked_at = time.monotonic()
+    return _snapshot
+
+
+def _check_for_changes():
+    global _data_version, _checked_at
+    conn = _version_connection()
+    shared_version = get_cache().get_counter(POSTS_VERSION_KEY)
+    if _snapshot is None or shared_version != _snapshot.version:
+        return _rebuild(conn, shared_version)
+
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if data_version != _data_version:
+        # Any table's commit bumps data_version; only reload when posts moved
+        row = conn.execute("SELECT COUNT(1), MAX(id), MAX(COALESCE(created_at, '')) FROM posts").fetchone()
+        if tuple(row) != _snapshot.fingerprint:
+            # Changed behind the app's back: bump so other workers' caches follow
+            return _rebuild(conn, bump_posts_version())
+        _data_version = data_version
+    _checked_at = time.monotonic()
+    return _snapshot
+
+
+def get_snapshot() -> PostSnapshot:
+    """Current snapshot; touches SQLite at most once per check interval"""
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked_at < POST_STORE_CHECK_INTERVAL:
+        return snapshot
+    with _lock:
+        return _check_for_changes()
+
+
+@on_posts_changed
+def refresh(post_id=None):
+    """Bump the shared version and rebuild immediately (runs after add_new_post commits)"""
+    with _lock:
+        return _rebuild(_version_connection(), bump_posts_version())
+
+
+def get_post_by_slug(post_slug: str):
+    """Get a single post by its slug"""
+    return get_snapshot().by_slug.get(post_slug)
+
+
+def get_all_posts():
+    """Get all posts (newest first) for sitemap generation"""
+    return get_snapshot().posts
+
+
+def get_post_count() -> int:
+    """Total number of posts"""
+    return len(get_snapshot().ids)
+
+
+def get_last_published():
+    """Publish time of the newest post, used as Last-Modified for listings"""
+    return max(filter(None, map(post_created_at, get_snapshot().posts)), default=None)
+
+
+def get_posts_paginated(page: int = 1, per_page: int = 9):
+    """Get paginated blog posts with pagination metadata"""
+    posts = get_snapshot().posts
+    total_pages = (len(posts) + per_page - 1) // per_page
+    start = max(page - 1, 0) * per_page
+    return {
+        'posts': posts[start:start + per_page],
+        'page': page,
+        'total_pages': total_pages,
+        'page_range': build_page_range(page, total_pages)
+    }
+
+
+def get_random_posts(limit: int = 6, seed=None, bucket_seconds=None):
+    """Get random posts for homepage carousel (see sample_ids for seed/bucket_seconds)"""
+    snapshot = get_snapshot()
+    return [snapshot.by_id[i] for i in sample_ids(snapshot.ids, limit, seed, bucket_seconds)]
@@ -0,0 +1,186 @@
+"""
+Opt-in profiling of live requests.
+
+With PROFILE_SAMPLE_RATE=N every Nth request of a worker is profiled (0, the
+default, profiles nothing); a request carrying the PROFILE_HEADER header
+with the profiling key is profiled regardless. PROFILE_MODE picks the
+profiler:
+- cprofile: deterministic, exact call counts, written as <name>.prof
+  (pstats format); slows the profiled request down noticeably
+- sample: a thread records the request thread's stack every
+  PROFILE_INTERVAL_MS, written as <name>.folded (collapsed stacks, the input
+  of flamegraph.pl and speedscope); cheap enough to leave on
+
+Files go to PROFILE_DIR as <epoch ms>-<pid>-<endpoint>.<ext>, keeping the
+newest PROFILE_KEEP. manage.py profile-report merges them.
+"""
+import cProfile, itertools, os, pstats, sys, threading, time
+from collections import Counter
+
+
+PROFILE_SAMPLE_RATE = int(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'cprofile')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'cache', 'profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '500'))
+PROFILE_HEADER = 'X-Profile'
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EXTENSIONS = {'cprofile': '.prof', 'sample': '.folded'}
+
+_requests = itertools.count(1)
+
+
+class CProfiler:
+    extension = EXTENSIONS['cprofile']
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, path):
+        self._profile.dump_stats(path)
+
+
+def frame_name(code) -> str:
+    """'function (path:line)' with the path relative to the project or site-packages"""
+    path = code.co_filename
+    for root in sorted({PROJECT_DIR, *sys.path}, key=len, reverse=True):
+        if root and path.startswith(root + os.sep):
+            path = path[len(root) + 1:]
+            break
+    # ';' separates frames in the collapsed format (the count follows the last space)
+    return f"{code.co_name} ({path}:{code.co_firstlineno})".replace(';', ':')
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled from a helper thread"""
+    extension = EXTENSIONS['sample']
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            # A sample taken while stop() runs would show the request waiting on this thread
+            if names and not self._stopped.is_set():
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+PROFILERS = {'cprofile': CProfiler, 'sample': StackSampler}
+
+
+def start_profiler(forced=False):
+    """A started profiler when this request is sampled (or forced), else None"""
+    if not forced and (PROFILE_SAMPLE_RATE <= 0 or next(_requests) % PROFILE_SAMPLE_RATE):
+        return None
+    profiler = PROFILERS.get(PROFILE_MODE, CProfiler)()
+    try:
+        profiler.start()
+    except ValueError as e:
+        # cProfile refuses while another profiler (e.g. a debugger) is active
+        print(f"Profiling unavailable: {e}")
+        return None
+    return profiler
+
+
+def _rotate(directory):
+    names = sorted(name for name in os.listdir(directory) if name.endswith(tuple(EXTENSIONS.values())))
+    for name in names[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else ():
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass  # another worker rotated it first
+
+
+def save_profile(profiler, endpoint: str) -> str:
+    """Stop profiler and write it to PROFILE_DIR, returns the file name"""
+    profiler.stop()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{int(time.time() * 1000)}-{os.getpid()}-{endpoint}{profiler.extension}"
+    path = os.path.join(PROFILE_DIR, name)
+    profiler.write(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    _rotate(PROFILE_DIR)
+    return name
+
+
+def profile_files(directory=PROFILE_DIR, endpoint=None, since=None):
+    """Paths of saved profiles, optionally of one endpoint and newer than `since` (epoch seconds)"""
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        parts = stem.split('-', 2)
+        if extension not in EXTENSIONS.values() or len(parts) != 3 or not parts[0].isdigit():
+            continue
+        if endpoint and parts[2] != endpoint:
+            continue
+        if since and int(parts[0]) < since * 1000:
+            continue
+        paths.append(os.path.join(directory, name))
+    return paths
+
+
+def merge_collapsed(paths) -> Counter:
+    """Summed sample counts per stack of the .folded files in paths"""
+    stacks = Counter()
+    for path in paths:
+        if not path.endswith(EXTENSIONS['sample']):
+            continue
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    return stacks
+
+
+def top_from_stacks(stacks: Counter, limit: int) -> str:
+    """Functions by samples spent in them (self) and under them (total)"""
+    own, total = Counter(), Counter()
+    samples = sum(stacks.values())
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    lines = [f"{samples} samples", f"{'self %':>7} {'total %':>8}  function"]
+    for frame, count in own.most_common(limit):
+        lines.append(f"{100 * count / samples:7.1f} {100 * total[frame] / samples:8.1f}  {frame}")
+    return '\n'.join(lines)
+
+
+def top_from_pstats(paths, sort: str, limit: int, stream) -> None:
+    """Print merged cProfile stats of the .prof files in paths"""
+    paths = [path for path in paths if path.endswith(EXTENSIONS['cprofile'])]
+    stats = pstats.Stats(*paths, stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
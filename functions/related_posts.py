@@ -0,0 +1,155 @@
+"""
+Precomputed "related articles" for post pages.
+
+Every post is turned into a TF-IDF vector of the normalised words already
+stored in the posts_fts search index (title words count TITLE_WEIGHT times),
+and the cosine similarity between posts is accumulated through an inverted
+index: only posts sharing at least one term are ever compared, terms found in
+more than MAX_DF of the posts are ignored and each post keeps its
+MAX_TERMS_PER_POST heaviest terms, so the work grows with the overlap between
+posts rather than with posts². The best RELATED_POSTS_COUNT neighbours of
+each post are stored in the related_posts table; post pages read them with a
+single primary-key lookup.
+
+Publishing a post only scores the new post against the others
+(add_post_neighbours); the scores stored for older posts keep the idf of the
+last full rebuild until `python manage.py related-posts` runs again.
+"""
+import heapq, math, os
+from collections import Counter, defaultdict
+from functions.database import db_connection, on_posts_changed
+from functions.post_store import get_snapshot
+
+
+RELATED_POSTS_COUNT = int(os.getenv('RELATED_POSTS_COUNT', '4'))
+TITLE_WEIGHT = 3
+# Terms in more than this share of posts don't tell posts apart
+MAX_DF = 0.5
+MAX_TERMS_PER_POST = 50
+# Below this cosine similarity a post isn't worth suggesting
+MIN_SCORE = 0.05
+
+
+def _terms(title: str, body: str) -> Counter:
+    counts = Counter(w for w in body.split() if len(w) > 2 and not w.isdigit())
+    for word in title.split():
+        if len(word) > 2 and not word.isdigit():
+            counts[word] += TITLE_WEIGHT
+    return counts
+
+
+def tfidf_vectors(documents: dict) -> dict:
+    """{post_id: {term: weight}} with sublinear tf, smoothed idf and unit length"""
+    df = Counter()
+    for counts in documents.values():
+        df.update(counts.keys())
+    total = len(documents)
+    max_df = max(2, MAX_DF * total)
+    idf = {term: math.log((1 + total) / (1 + n)) + 1 for term, n in df.items() if 1 < n <= max_df}
+
+    vectors = {}
+    for post_id, counts in documents.items():
+        weights = [(term, (1 + math.log(tf)) * idf[term]) for term, tf in counts.items() if term in idf]
+        weights = heapq.nlargest(MAX_TERMS_PER_POST, weights, key=lambda item: item[1])
+        norm = math.sqrt(sum(w * w for _, w in weights))
+        if norm:
+            vectors[post_id] = {term: w / norm for term, w in weights}
+    return vectors
+
+
+def nearest_neighbours(vectors: dict, count: int = RELATED_POSTS_COUNT) -> dict:
+    """{post_id: [(related_id, cosine), ...]} best first, through an inverted index of the vectors"""
+    postings = defaultdict(list)
+    for post_id, vector in vectors.items():
+        for term, weight in vector.items():
+            postings[term].append((post_id, weight))
+
+    neighbours = {}
+    for post_id, vector in vectors.items():
+        scores = defaultdict(float)
+        for term, weight in vector.items():
+            for other_id, other_weight in postings[term]:
+                scores[other_id] += weight * other_weight
+        scores.pop(post_id, None)
+        best = heapq.nlargest(count, scores.items(), key=lambda item: (item[1], item[0]))
+        neighbours[post_id] = [(other_id, score) for other_id, score in best if score >= MIN_SCORE]
+    return neighbours
+
+
+def _load_vectors() -> dict:
+    with db_connection() as conn:
+        documents = {row['rowid']: _terms(row['title'], row['body'])
+                     for row in conn.execute("SELECT rowid, title, body FROM posts_fts")}
+    return tfidf_vectors(documents)
+
+
+def rebuild_related_posts(count: int = RELATED_POSTS_COUNT) -> int:
+    """Recompute every post's neighbours from the search index, returns rows stored"""
+    neighbours = nearest_neighbours(_load_vectors(), count)
+    rows = [(post_id, rank, related_id, round(score, 6))
+            for post_id, related in neighbours.items()
+            for rank, (related_id, score) in enumerate(related)]
+    with db_connection() as conn, conn:
+        conn.execute("DELETE FROM related_posts")
+        conn.executemany("INSERT INTO related_posts (post_id, rank, related_id, score) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def related_posts_missing() -> bool:
+    """True when posts exist but no neighbours were ever computed"""
+    with db_connection() as conn:
+        return (conn.execute("SELECT 1 FROM related_posts LIMIT 1").fetchone() is None
+                and conn.execute("SELECT 1 FROM posts LIMIT 1").fetchone() is not None)
+
+
+def get_related_posts(post_id: int, limit: int = RELATED_POSTS_COUNT) -> list:
+    """Stored neighbours of a post, best first, as snapshot posts"""
+    with db_connection() as conn:
+        rows = conn.execute("SELECT related_id FROM related_posts WHERE post_id = ? ORDER BY rank LIMIT ?",
+                            (post_id, limit)).fetchall()
+    by_id = get_snapshot().by_id
+    return [by_id[row['related_id']] for row in rows if row['related_id'] in by_id]
+
+
+def add_post_neighbours(post_id: int, count: int = RELATED_POSTS_COUNT) -> int:
+    """
+    Store a new post's neighbours and add it to the lists of the posts it is
+    closer to than one of their stored neighbours, returns the posts updated
+    """
+    vectors = _load_vectors()
+    vector = vectors.pop(post_id, None)
+    if vector is None:
+        return 0
+    scores = {}
+    for other_id, other in vectors.items():
+        score = sum(weight * other.get(term, 0.0) for term, weight in vector.items())
+        if score >= MIN_SCORE:
+            scores[other_id] = score
+
+    lists = {post_id: scores.items()}
+    with db_connection() as conn, conn:
+        stored = defaultdict(list)
+        for row in conn.execute("SELECT post_id, related_id, score FROM related_posts ORDER BY post_id, rank"):
+            if row['post_id'] in scores and row['related_id'] != post_id:
+                stored[row['post_id']].append((row['related_id'], row['score']))
+        for other_id, score in scores.items():
+            current = stored[other_id]
+            if len(current) < count or score > current[-1][1]:
+                lists[other_id] = current + [(post_id, score)]
+
+        for list_id, related in lists.items():
+            best = heapq.nlargest(count, related, key=lambda item: (item[1], item[0]))
+            conn.execute("DELETE FROM related_posts WHERE post_id = ?", (list_id,))
+            conn.executemany("INSERT INTO related_posts (post_id, rank, related_id, score) VALUES (?, ?, ?, ?)",
+                             [(list_id, rank, related_id, round(score, 6))
+                              for rank, (related_id, score) in enumerate(best)])
+    return len(lists)
+
+
+@on_posts_changed(first=True)
+def refresh_related_posts(post_id=None):
+    """Runs before post_store's refresh, so its version bump also covers the new neighbours"""
+    if post_id is None:
+        rebuild_related_posts()
+    else:
+        add_post_neighbours(post_id)
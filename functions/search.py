@@ -0,0 +1,109 @@
+"""
+Full-text search over posts with SQLite FTS5.
+
+add_new_post indexes titles and tag-stripped bodies in the posts_fts table
+after Arabic normalisation (seo.normalize_word: diacritics and tatweel removed,
+alef/yaa/taa marbuta variants folded, the definite article stripped), which
+the unicode61 tokenizer can't do on its own. Queries are normalised the same
+way and ranked with bm25, title matches weighing more than body matches.
+
+Snippets are cut from the original text in Python, word by word, so they
+keep the post's spelling while highlighting words that matched after
+normalisation. Results for repeated queries come from an LRU cache keyed on
+the posts version, so publishing a post invalidates it.
+"""
+from functools import lru_cache
+from markupsafe import Markup, escape
+from functions.database import db_connection
+from functions.post_store import get_snapshot
+from functions.seo import WORD_RE, normalize_word
+
+
+# bm25 column weights: (title, body)
+SEARCH_WEIGHTS = (10.0, 1.0)
+SEARCH_MAX_RESULTS = 50
+SEARCH_CACHE_SIZE = 256
+SNIPPET_WORDS = 30
+
+
+def plain_text(html: str) -> str:
+    """Post body without markup, for snippets"""
+    return Markup(html or '').striptags()
+
+
+def query_words(query: str) -> tuple:
+    """Normalised words of user input (at most 10)"""
+    return tuple(w for w in (normalize_word(w) for w in WORD_RE.findall(query or '')) if w)[:10]
+
+
+def build_match_query(words):
+    """FTS5 MATCH expression requiring every word, the last one as a prefix (search as you type)"""
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def make_snippet(text: str, words, length: int = SNIPPET_WORDS) -> Markup:
+    """Window of the original text with the most query hits, matching words wrapped in <mark>"""
+    tokens = text.split()
+    if not tokens:
+        return Markup('')
+
+    def matches(word):
+        normalized = normalize_word(''.join(WORD_RE.findall(word)))
+        return bool(normalized) and any(normalized.startswith(q) for q in words)
+
+    hits = [matches(t) for t in tokens]
+    best_start, best_score = 0, -1
+    window = sum(hits[:length])
+    for start in range(max(1, len(tokens) - length + 1)):
+        if start:
+            window += (hits[start + length - 1] if start + length - 1 < len(tokens) else 0) - hits[start - 1]
+        if window > best_score:
+            best_start, best_score = start, window
+
+    parts = []
+    for word, hit in zip(tokens[best_start:best_start + length], hits[best_start:best_start + length]):
+        parts.append(Markup('<mark>%s</mark>') % word if hit else escape(word))
+    snippet = Markup(' ').join(parts)
+    if best_start > 0:
+        snippet = Markup('… ') + snippet
+    if best_start + length < len(tokens):
+        snippet += Markup(' …')
+    return snippet
+
+
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _cached_search(words, limit, version):
+    with db_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT rowid, bm25(posts_fts, {SEARCH_WEIGHTS[0]}, {SEARCH_WEIGHTS[1]}) AS rank
+            FROM posts_fts WHERE posts_fts MATCH ?
+            ORDER BY rank LIMIT ?
+        """, (build_match_query(words), limit)).fetchall()
+
+    by_id = get_snapshot().by_id
+    results = []
+    for row in rows:
+        post = by_id.get(row['rowid'])
+        if post is None:
+            continue
+        results.append({
+            'id': post['id'],
+            'title': post['title'],
+            'slug': post['slug'],
+            'date': post['date'],
+            'image': post['image'],
+            'snippet': make_snippet(plain_text(post['content']), words),
+            'score': round(-row['rank'], 4),
+        })
+    return tuple(results)
+
+
+def search(query: str, limit: int = 10):
+    """Posts matching query, best first, as dicts with a highlighted 'snippet' (Markup)"""
+    words = query_words(query)
+    if not words:
+        return ()
+    # The posts version in the key drops cached results once a post is published
+    return _cached_search(words, min(max(limit, 1), SEARCH_MAX_RESULTS), get_snapshot().version)
@@ -0,0 +1,60 @@
+import math, re
+from markupsafe import Markup
+
+
+EXCERPT_LENGTH = 150
+META_DESCRIPTION_LENGTH = 155
+WORDS_PER_MINUTE = 200
+
+# Arabic normalisation for the search index (see functions/search.py):
+# harakat, Quranic marks and tatweel are dropped, letter variants folded and
+# the definite article (with attached particles, longest first) stripped
+_ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_ARABIC_FOLDS = str.maketrans({'\u0623': '\u0627', '\u0625': '\u0627', '\u0622': '\u0627', '\u0671': '\u0627',
+                               '\u0649': '\u064a', '\u0629': '\u0647', '\u0624': '\u0648', '\u0626': '\u064a'})
+_ARABIC_PREFIXES = ('\u0648\u0627\u0644', '\u0628\u0627\u0644', '\u0643\u0627\u0644', '\u0641\u0627\u0644',
+                    '\u0644\u0644', '\u0627\u0644')
+WORD_RE = re.compile(r'\w+')
+
+
+def truncate_text(text: str, length: int, end: str = '...') -> str:
+    """Cut text at a word boundary, like Jinja's truncate filter"""
+    if len(text) <= length:
+        return text
+    cut = text[:length - len(end)].rsplit(' ', 1)[0]
+    return cut.rstrip(' ,.;:-') + end
+
+
+def post_text_fields(content: str) -> dict:
+    """Plain-text excerpt, meta description, word count and reading time for a post body"""
+    # Same stripping as the templates' striptags filter (tags removed, entities decoded)
+    text = Markup(content or '').striptags()
+    word_count = len(text.split())
+    return {
+        'excerpt': truncate_text(text, EXCERPT_LENGTH),
+        'meta_description': truncate_text(text, META_DESCRIPTION_LENGTH),
+        'word_count': word_count,
+        'reading_time': max(1, math.ceil(word_count / WORDS_PER_MINUTE)),
+    }
+
+
+def normalize_word(word: str) -> str:
+    """Lowercased word with Arabic variants folded, as stored in the search index"""
+    word = _ARABIC_DIACRITICS.sub('', word.lower()).translate(_ARABIC_FOLDS)
+    for prefix in _ARABIC_PREFIXES:
+        # Keep at least 2 letters so short words aren't reduced to nothing
+        if word.startswith(prefix) and len(word) - len(prefix) >= 2:
+            return word[len(prefix):]
+    return word
+
+
+def normalize_text(text: str) -> str:
+    return ' '.join(normalize_word(w) for w in WORD_RE.findall(text))
+
+
+def search_index_fields(title: str, content: str) -> dict:
+    """Normalised title and tag-stripped body for the posts_fts index"""
+    return {
+        'title': normalize_text(title or ''),
+        'body': normalize_text(Markup(content or '').striptags()),
+    }
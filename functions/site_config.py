@@ -0,0 +1,20 @@
+"""
+Site settings shared by app.py and the build scripts.
+
+Importing this module has no side effects (unlike importing app, which
+migrates the database and starts worker threads), so build_assets.py can
+render the sitemap from the same settings the app serves it with.
+"""
+import os
+
+
+SITE_URL = 'https://www.iiot-bay.com'
+LANGUAGES = ['en', 'ar']
+DEFAULT_LANGUAGE = 'ar'
+# Sitemap index and shards with their .gz/.br variants (see functions/sitemap.py)
+BUILD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build')
+
+
+def sitemap_args():
+    """(directory, base_url, languages, default_lang) for functions.sitemap"""
+    return BUILD_DIR, SITE_URL, LANGUAGES, DEFAULT_LANGUAGE
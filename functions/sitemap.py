@@ -0,0 +1,194 @@
+"""
+Sitemap files under build/, written incrementally.
+
+/sitemap.xml is a sitemap index pointing at:
+- sitemap-pages.xml: the language-prefixed pages, with hreflang alternates
+- sitemap-posts-<n>.xml: posts in publish (id) order, SITEMAP_SHARD_SIZE per
+  file (50,000 is the protocol's limit)
+
+Every file is written together with .gz (and .br when brotli is installed)
+siblings for the precompressed-file serving in app.py. Publishing a post
+only rewrites the shard holding it, the pages file (the blog's lastmod moves)
+and the index, so the work per publish doesn't grow with the number of
+posts. Post lastmod comes from posts.created_at. Writers in different
+workers are serialised with an flock on the build directory.
+"""
+import fcntl, os
+from contextlib import contextmanager
+from urllib.parse import quote
+from xml.sax.saxutils import escape, quoteattr
+from functions.compression import ENCODINGS, ENCODING_SUFFIXES, compress
+from functions.database import db_connection, parse_created_at
+
+
+SITEMAP_SHARD_SIZE = int(os.getenv('SITEMAP_SHARD_SIZE', '50000'))
+
+INDEX_NAME = 'sitemap.xml'
+PAGES_NAME = 'sitemap-pages.xml'
+POSTS_NAME = 'sitemap-posts-{}.xml'
+
+# Public pages that exist in every language ('' is the home page)
+STATIC_PAGES = ('', 'about', 'services', 'blog', 'contact', 'terms')
+
+# Last content change of pages that don't list posts; pages that do
+# (home, blog) use the newest post's publish time when it is later
+PAGE_LASTMOD = {
+    '': '2026-01-19',
+    'about': '2026-01-19',
+    'services': '2026-01-19',
+    'blog': '2026-01-19',
+    'contact': '2026-01-25',
+    'terms': '2026-01-19',
+}
+POST_LISTING_PAGES = ('', 'blog')
+
+# Posts without a slug have no URL
+POSTS_WITH_SLUG = "slug IS NOT NULL AND slug != ''"
+
+URLSET_OPEN = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"\n'
+               '        xmlns:xhtml="http://www.w3.org/1999/xhtml">')
+
+
+def w3c_datetime(created_at):
+    """posts.created_at as a W3C datetime, None if unparseable (see database.parse_created_at)"""
+    parsed = parse_created_at(created_at)
+    return parsed.isoformat() if parsed else None
+
+
+def _write(directory, name, xml):
+    """Atomically replace directory/name, compressed siblings first so they're never older"""
+    data = xml.encode('utf-8')
+    path = os.path.join(directory, name)
+    for encoding in ENCODINGS:
+        variant = path + ENCODING_SUFFIXES[encoding]
+        with open(variant + '.tmp', 'wb') as f:
+            f.write(compress(data, encoding, level='static'))
+        os.replace(variant + '.tmp', variant)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def _remove(directory, name):
+    for suffix in ('', *ENCODING_SUFFIXES.values()):
+        try:
+            os.remove(os.path.join(directory, name + suffix))
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def _locked(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.sitemap.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _shard_lastmods(conn):
+    """[lastmod of shard 1, shard 2, ...] (max created_at of the posts in each)"""
+    rows = conn.execute(f"""
+        SELECT shard, MAX(created_at) AS lastmod FROM (
+            SELECT (ROW_NUMBER() OVER (ORDER BY id) - 1) / ? AS shard, created_at
+            FROM posts WHERE {POSTS_WITH_SLUG}
+        ) GROUP BY shard ORDER BY shard
+    """, (SITEMAP_SHARD_SIZE,)).fetchall()
+    return [row['lastmod'] for row in rows]
+
+
+def _write_pages(conn, directory, base_url, languages, default_lang):
+    newest = w3c_datetime(conn.execute(f"SELECT MAX(created_at) FROM posts WHERE {POSTS_WITH_SLUG}").fetchone()[0])
+    lines = [URLSET_OPEN]
+    for page in STATIC_PAGES:
+        lastmod = PAGE_LASTMOD[page]
+        if page in POST_LISTING_PAGES and newest and newest > lastmod:
+            lastmod = newest
+        urls = {lang: f"{base_url}/{lang}/{page}" for lang in languages}
+        alternates = [f'    <xhtml:link rel="alternate" hreflang="{lang}" href={quoteattr(urls[lang])}/>' for lang in languages]
+        alternates.append(f'    <xhtml:link rel="alternate" hreflang="x-default" href={quoteattr(urls[default_lang])}/>')
+        # Default language first, one <url> per language, each listing every alternate
+        for lang in sorted(languages, key=lambda lang: lang != default_lang):
+            lines.append('  <url>')
+            lines.append(f'    <loc>{escape(urls[lang])}</loc>')
+            lines.append(f'    <lastmod>{lastmod}</lastmod>')
+            lines.extend(alternates)
+            lines.append('  </url>')
+    lines.append('</urlset>')
+    _write(directory, PAGES_NAME, '\n'.join(lines))
+
+
+def _write_post_shard(conn, directory, base_url, shard):
+    """Write sitemap-posts-<shard + 1>.xml"""
+    rows = conn.execute(f"""
+        SELECT slug, created_at FROM posts WHERE {POSTS_WITH_SLUG}
+        ORDER BY id LIMIT ? OFFSET ?
+    """, (SITEMAP_SHARD_SIZE, shard * SITEMAP_SHARD_SIZE)).fetchall()
+    lines = [URLSET_OPEN]
+    for row in rows:
+        # Posts are language-neutral (/post/<slug>), so no hreflang alternates
+        lines.append('  <url>')
+        lines.append(f"    <loc>{escape(base_url + '/post/' + quote(row['slug']))}</loc>")
+        lastmod = w3c_datetime(row['created_at'])
+        if lastmod:
+            lines.append(f'    <lastmod>{lastmod}</lastmod>')
+        lines.append('  </url>')
+    lines.append('</urlset>')
+    _write(directory, POSTS_NAME.format(shard + 1), '\n'.join(lines))
+
+
+def _write_index(directory, base_url, shard_lastmods):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    entries = [(PAGES_NAME, None)] + [(POSTS_NAME.format(i + 1), lastmod) for i, lastmod in enumerate(shard_lastmods)]
+    for name, created_at in entries:
+        lines.append('  <sitemap>')
+        lines.append(f'    <loc>{escape(base_url + "/" + name)}</loc>')
+        lastmod = w3c_datetime(created_at)
+        if lastmod:
+            lines.append(f'    <lastmod>{lastmod}</lastmod>')
+        lines.append('  </sitemap>')
+    lines.append('</sitemapindex>')
+    _write(directory, INDEX_NAME, '\n'.join(lines))
+
+
+def build_all(directory, base_url, languages, default_lang) -> int:
+    """Write the index and every shard, removing shards that no longer exist; returns post shards"""
+    with _locked(directory), db_connection() as conn:
+        shard_lastmods = _shard_lastmods(conn)
+        _write_pages(conn, directory, base_url, languages, default_lang)
+        for shard in range(len(shard_lastmods)):
+            _write_post_shard(conn, directory, base_url, shard)
+        shard = len(shard_lastmods)
+        while os.path.exists(os.path.join(directory, POSTS_NAME.format(shard + 1))):
+            _remove(directory, POSTS_NAME.format(shard + 1))
+            shard += 1
+        # Index last, so it never points at a shard that isn't written yet
+        _write_index(directory, base_url, shard_lastmods)
+    return len(shard_lastmods)
+
+
+def update_for_post(directory, base_url, languages, default_lang, post_id):
+    """Rewrite only the shard holding post_id, the pages file and the index (full build if none exists)"""
+    # A sitemap.xml without the pages file predates sharding (a single urlset)
+    if not os.path.exists(os.path.join(directory, PAGES_NAME)):
+        build_all(directory, base_url, languages, default_lang)
+        return
+    with _locked(directory), db_connection() as conn:
+        position = conn.execute(f"SELECT COUNT(1) FROM posts WHERE id < ? AND {POSTS_WITH_SLUG}", (post_id,)).fetchone()[0]
+        shard_lastmods = _shard_lastmods(conn)
+        _write_post_shard(conn, directory, base_url, position // SITEMAP_SHARD_SIZE)
+        _write_pages(conn, directory, base_url, languages, default_lang)
+        _write_index(directory, base_url, shard_lastmods)
+
+
+def is_sitemap_name(name: str) -> bool:
+    """Whether name is one of the files this module writes (safe to serve)"""
+    if name in (INDEX_NAME, PAGES_NAME):
+        return True
+    prefix, suffix = POSTS_NAME.split('{}')
+    number = name[len(prefix):-len(suffix)] if name.startswith(prefix) and name.endswith(suffix) else ''
+    return number.isdigit() and not number.startswith('0')
@@ -0,0 +1,75 @@
+"""
+In-memory membership of newsletter_subscribers, so a repeated signup is
+answered without touching the database.
+
+Each worker loads a 64-bit hash of every subscribed address on first use
+(8 bytes of payload per address instead of the string; a collision between
+two addresses is around one in 10^8 for a million subscribers) and adds
+addresses as it queues them. Signups accepted by other workers are picked
+up by loading rows past the highest id seen, at most once every
+SUBSCRIBERS_REFRESH_INTERVAL seconds and only when an address isn't known.
+"""
+import hashlib, os, threading, time
+from functions.database import db_connection
+
+
+SUBSCRIBERS_REFRESH_INTERVAL = float(os.getenv('SUBSCRIBERS_REFRESH_INTERVAL', '5'))
+
+_lock = threading.Lock()
+_hashes = None
+_max_id = 0
+_refreshed_at = 0.0
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def _hash(email: str) -> int:
+    return int.from_bytes(hashlib.blake2b(normalize_email(email).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _load_new_rows():
+    """Add rows past the highest id seen (everything on the first call); caller holds _lock"""
+    global _hashes, _max_id, _refreshed_at
+    if _hashes is None:
+        _hashes = set()
+    with db_connection() as conn:
+        for row in conn.execute("SELECT id, email FROM newsletter_subscribers WHERE id > ? ORDER BY id", (_max_id,)):
+            _hashes.add(_hash(row['email']))
+            _max_id = row['id']
+    _refreshed_at = time.monotonic()
+
+
+def _known(key) -> bool:
+    """Whether key is subscribed, reloading new rows when it isn't (caller holds _lock)"""
+    if _hashes is None:
+        _load_new_rows()
+    if key in _hashes:
+        return True
+    if time.monotonic() - _refreshed_at >= SUBSCRIBERS_REFRESH_INTERVAL:
+        _load_new_rows()
+        return key in _hashes
+    return False
+
+
+def is_subscribed(email: str) -> bool:
+    with _lock:
+        return _known(_hash(email))
+
+
+def add_subscriber(email: str) -> bool:
+    """Record email as subscribed, False if it already was"""
+    key = _hash(email)
+    with _lock:
+        if _known(key):
+            return False
+        _hashes.add(key)
+        return True
+
+
+def forget_subscriber(email: str):
+    """Undo add_subscriber when the signup couldn't be queued after all"""
+    with _lock:
+        if _hashes is not None:
+            _hashes.discard(_hash(email))
@@ -0,0 +1,202 @@
+"""
+Cloudflare Turnstile verification for the contact form.
+
+Calls to the siteverify endpoint go through one keep-alive requests.Session
+per process and run on a small thread pool, so a request can start
+verification, validate the form meanwhile and then wait at most
+TURNSTILE_TIMEOUT seconds for the verdict. When the pool is saturated the
+call fails fast instead of queueing behind a slow verifier.
+
+Verdicts are cached by token for TURNSTILE_CACHE_TTL seconds, so a form
+resubmitted after fixing a field doesn't spend the single-use token twice.
+A passed verdict only admits one submission: redeem() removes it when a
+submission is accepted, and siteverify's timeout-or-duplicate answer for a
+replayed token counts as failed. A circuit breaker stops calling the verifier for
+TURNSTILE_BREAKER_RESET seconds after TURNSTILE_BREAKER_FAILURES failures
+in a row. TURNSTILE_VERIFY_URL points the client at a local stand-in
+verifier (see manage.py turnstile-standin).
+"""
+import hashlib, os, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import requests
+from requests.adapters import HTTPAdapter
+
+
+TURNSTILE_VERIFY_URL = os.getenv('TURNSTILE_VERIFY_URL', 'https://challenges.cloudflare.com/turnstile/v0/siteverify')
+TURNSTILE_TIMEOUT = float(os.getenv('TURNSTILE_TIMEOUT', '3'))
+TURNSTILE_WORKERS = int(os.getenv('TURNSTILE_WORKERS', '4'))
+# Verifications queued or running at once before new ones fail fast
+TURNSTILE_MAX_PENDING = int(os.getenv('TURNSTILE_MAX_PENDING', str(TURNSTILE_WORKERS * 4)))
+TURNSTILE_CACHE_TTL = float(os.getenv('TURNSTILE_CACHE_TTL', '300'))
+TURNSTILE_CACHE_SIZE = 10000
+TURNSTILE_BREAKER_FAILURES = int(os.getenv('TURNSTILE_BREAKER_FAILURES', '5'))
+TURNSTILE_BREAKER_RESET = float(os.getenv('TURNSTILE_BREAKER_RESET', '30'))
+
+# Verdicts: the token is valid, invalid, or the verifier couldn't be asked
+PASSED, FAILED, UNAVAILABLE = 'passed', 'failed', 'unavailable'
+
+
+class CircuitBreaker:
+    """
+    Closed while calls succeed; opens after `failures` consecutive failures and
+    rejects calls for `reset_timeout` seconds, then lets one probe through
+    (half-open) and closes again if it succeeds.
+    """
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self._opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or self._consecutive >= self.failures:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class TurnstileVerifier:
+    """Pooled, cached and circuit-broken client for one siteverify endpoint"""
+
+    def __init__(self, secret, url=TURNSTILE_VERIFY_URL, timeout=TURNSTILE_TIMEOUT,
+                 workers=TURNSTILE_WORKERS, max_pending=TURNSTILE_MAX_PENDING, cache_ttl=TURNSTILE_CACHE_TTL,
+                 breaker=None):
+        self.secret = secret
+        self.url = url
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.breaker = breaker or CircuitBreaker(TURNSTILE_BREAKER_FAILURES, TURNSTILE_BREAKER_RESET)
+        self._session = requests.Session()
+        self._session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='turnstile')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._verdicts = OrderedDict()
+        self._verdicts_lock = threading.Lock()
+
+    def _cache_key(self, token):
+        return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+    def _cached(self, key):
+        with self._verdicts_lock:
+            item = self._verdicts.get(key)
+            if item is None:
+                return None
+            verdict, expires_at = item
+            if expires_at < time.monotonic():
+                del self._verdicts[key]
+                return None
+            return verdict
+
+    def _remember(self, key, verdict):
+        with self._verdicts_lock:
+            self._verdicts[key] = (verdict, time.monotonic() + self.cache_ttl)
+            self._verdicts.move_to_end(key)
+            while len(self._verdicts) > TURNSTILE_CACHE_SIZE:
+                self._verdicts.popitem(last=False)
+
+    def _call(self, key, token, remote_ip):
+        try:
+            response = self._session.post(self.url, data={'secret': self.secret, 'response': token, 'remoteip': remote_ip},
+                                          timeout=self.timeout)
+            if response.status_code >= 500:
+                raise requests.HTTPError(f"siteverify returned {response.status_code}")
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Turnstile verification error: {e}")
+            self.breaker.record_failure()
+            return UNAVAILABLE
+        finally:
+            self._slots.release()
+
+        self.breaker.record_success()
+        if result.get('success'):
+            self._remember(key, PASSED)
+            return PASSED
+        if 'timeout-or-duplicate' not in result.get('error-codes', ()):
+            self._remember(key, FAILED)
+        # A replayed token fails without touching the verdict cached for its first use
+        return FAILED
+
+    def submit(self, token: str, remote_ip=None):
+        """Start verifying token, returns a callable wait(timeout=None) -> verdict"""
+        key = self._cache_key(token)
+        verdict = self._cached(key)
+        if verdict is None:
+            # Every slot busy or verifier degraded: don't queue behind it. The
+            # slot comes first so a half-open breaker's probe is always sent
+            if not self._slots.acquire(blocking=False):
+                verdict = UNAVAILABLE
+            elif not self.breaker.allow():
+                self._slots.release()
+                verdict = UNAVAILABLE
+        if verdict is not None:
+            return lambda timeout=None: verdict
+
+        future = self._pool.submit(self._call, key, token, remote_ip)
+
+        def wait(timeout=None):
+            try:
+                return future.result(timeout=self.timeout + 1 if timeout is None else timeout)
+            except FutureTimeoutError:
+                return UNAVAILABLE
+        return wait
+
+    def redeem(self, token: str) -> bool:
+        """Use up the passed verdict of token; False if it isn't (or no longer) cached as passed"""
+        key = self._cache_key(token)
+        with self._verdicts_lock:
+            item = self._verdicts.get(key)
+            if item is None or item[0] != PASSED or item[1] < time.monotonic():
+                return False
+            del self._verdicts[key]
+            return True
+
+    def unredeem(self, token: str):
+        """Put back a redeemed verdict when the submission couldn't be stored after all"""
+        self._remember(self._cache_key(token), PASSED)
+
+    def verify(self, token: str, remote_ip=None) -> str:
+        """Verdict for token, waiting for the verifier if it isn't cached"""
+        return self.submit(token, remote_ip)()
+
+
+_verifier = None
+_verifier_pid = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier() -> TurnstileVerifier:
+    """Verifier of this process (sessions and threads aren't shared across a fork)"""
+    global _verifier, _verifier_pid
+    with _verifier_lock:
+        if _verifier is None or _verifier_pid != os.getpid():
+            _verifier = TurnstileVerifier(os.getenv('TURNSTILE_SECRET_KEY'))
+            _verifier_pid = os.getpid()
+        return _verifier
@@ -0,0 +1,255 @@
+"""
+Write-behind queue for contact messages and newsletter signups.
+
+Submissions are appended to a spool file and acknowledged straight away; a
+background thread inserts them into SQLite in one transaction once
+WRITE_QUEUE_BATCH_ROWS rows are waiting or WRITE_QUEUE_FLUSH_MS after the
+first one arrived, so a burst costs one commit per batch instead of one per
+request. enqueue() refuses new rows while WRITE_QUEUE_MAX_PENDING are waiting
+(the API answers 503), and the queue is flushed when the process exits.
+
+Each batch has its own spool segment (spool/<pid>-<n>.jsonl), deleted once
+the batch is committed and flock'ed by its process meanwhile. A batch whose
+commit fails (e.g. the database is locked) keeps its segment and is retried
+by the flusher after WRITE_QUEUE_RETRY_MS, doubling up to
+WRITE_QUEUE_RETRY_MAX_MS; its rows still count against MAX_PENDING. Segments
+left behind by a crashed worker, or still failing at exit, are unlocked, so
+the next process to start replays them into the database. A crash between the commit and the delete
+replays that batch again: subscribers are deduplicated by their UNIQUE
+email, messages can then be stored twice.
+"""
+import atexit, fcntl, json, os, threading, time
+from datetime import datetime, timezone
+from functions.database import db_connection
+
+
+WRITE_QUEUE_FLUSH_MS = int(os.getenv('WRITE_QUEUE_FLUSH_MS', '200'))
+WRITE_QUEUE_BATCH_ROWS = int(os.getenv('WRITE_QUEUE_BATCH_ROWS', '100'))
+WRITE_QUEUE_MAX_PENDING = int(os.getenv('WRITE_QUEUE_MAX_PENDING', '5000'))
+WRITE_QUEUE_RETRY_MS = int(os.getenv('WRITE_QUEUE_RETRY_MS', '1000'))
+WRITE_QUEUE_RETRY_MAX_MS = int(os.getenv('WRITE_QUEUE_RETRY_MAX_MS', '60000'))
+SPOOL_DIR = os.getenv('WRITE_QUEUE_SPOOL_DIR', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'spool'))
+
+# table -> columns, in the order rows are passed to enqueue(). The timestamp
+# is taken at enqueue time, so it doesn't move with the flush
+TABLES = {
+    'contact_messages': ('full_name', 'email_address', 'subject', 'message', 'submitted_at'),
+    'newsletter_subscribers': ('email', 'subscribed_at'),
+}
+
+
+def _now():
+    # Same format as SQLite's CURRENT_TIMESTAMP (the columns' default)
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def insert_batch(rows) -> int:
+    """Insert [(table, values), ...] in one transaction, returns rows given"""
+    by_table = {}
+    for table, values in rows:
+        by_table.setdefault(table, []).append(tuple(values))
+    with db_connection() as conn, conn:
+        for table, values in by_table.items():
+            columns = TABLES[table]
+            # OR IGNORE: a duplicate subscriber mustn't fail the whole batch
+            conn.executemany(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                             values)
+    return len(rows)
+
+
+class WriteBehindQueue:
+    def __init__(self, spool_dir=SPOOL_DIR, flush_ms=WRITE_QUEUE_FLUSH_MS,
+                 batch_rows=WRITE_QUEUE_BATCH_ROWS, max_pending=WRITE_QUEUE_MAX_PENDING,
+                 retry_ms=WRITE_QUEUE_RETRY_MS, retry_max_ms=WRITE_QUEUE_RETRY_MAX_MS):
+        self.spool_dir = spool_dir
+        self.flush_interval = flush_ms / 1000
+        self.batch_rows = batch_rows
+        self.max_pending = max_pending
+        self.retry_interval = retry_ms / 1000
+        self.retry_max_interval = retry_max_ms / 1000
+        self._pending = []
+        # Batches whose commit failed: [rows, segment, failed attempts, retry at (monotonic)]
+        self._failed = []
+        self._first_at = None
+        self._segment = None
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+        os.makedirs(spool_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+        self._thread.start()
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.spool_dir, f"{os.getpid()}-{self._sequence}.jsonl")
+        f = open(path, 'a', encoding='utf-8')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def enqueue(self, table: str, values) -> bool:
+        """Spool and queue one row, False when the queue is full or stopped"""
+        row = (table, [*values, _now()])
+        if len(row[1]) != len(TABLES[table]):
+            raise ValueError(f"{table} takes {len(TABLES[table]) - 1} values")
+        with self._cond:
+            waiting = len(self._pending) + sum(len(batch[0]) for batch in self._failed)
+            if self._stopped or waiting >= self.max_pending:
+                return False
+            if self._segment is None:
+                self._segment = self._open_segment()
+            # One write() per line; it survives the process dying before the flush
+            self._segment.write(json.dumps(row, ensure_ascii=False) + '\n')
+            self._segment.flush()
+            self._pending.append(row)
+            if self._first_at is None:
+                # Starts the flusher's FLUSH_MS countdown
+                self._first_at = time.monotonic()
+                self._cond.notify()
+            elif len(self._pending) >= self.batch_rows:
+                self._cond.notify()
+        return True
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _take(self):
+        """Pending rows and their spool segment, leaving an empty queue (caller holds _cond)"""
+        rows, segment = self._pending, self._segment
+        self._pending, self._segment, self._first_at = [], None, None
+        return rows, segment
+
+    def _commit(self, rows, segment, attempts=0):
+        try:
+            insert_batch(rows)
+        except Exception as e:
+            # Keep the segment (and its lock) and let the flusher try again later
+            delay = min(self.retry_interval * 2 ** attempts, self.retry_max_interval)
+            print(f"Write queue flush of {len(rows)} row(s) failed, retrying in {delay:g}s: {e}")
+            with self._cond:
+                self._failed.append([rows, segment, attempts + 1, time.monotonic() + delay])
+                self._cond.notify()
+            return False
+        os.remove(segment.name)
+        segment.close()
+        return True
+
+    def flush(self) -> int:
+        """Commit whatever is pending now, returns rows written"""
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending:
+                    return 0
+                rows, segment = self._take()
+            return len(rows) if self._commit(rows, segment) else 0
+
+    def retry_failed(self, force=False) -> int:
+        """Commit failed batches whose retry is due (all with force), returns rows written"""
+        with self._flush_lock:
+            with self._cond:
+                now = time.monotonic()
+                due = [batch for batch in self._failed if force or batch[3] <= now]
+                self._failed = [batch for batch in self._failed if not (force or batch[3] <= now)]
+            return sum(len(rows) for rows, segment, attempts, _ in due
+                       if self._commit(rows, segment, attempts))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if len(self._pending) >= self.batch_rows:
+                        break
+                    deadlines = [batch[3] for batch in self._failed]
+                    if self._first_at is not None:
+                        deadlines.append(self._first_at + self.flush_interval)
+                    if not deadlines:
+                        self._cond.wait()
+                        continue
+                    remaining = min(deadlines) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+            # Due retries first, they hold the older rows
+            self.retry_failed()
+            self.flush()
+
+    def close(self):
+        """Stop the flusher and commit everything still queued (runs at exit)"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.retry_failed(force=True)
+        self.flush()
+        with self._cond:
+            failed, self._failed = self._failed, []
+        # Unlocked, so the next process to start replays them
+        for rows, segment, _, _ in failed:
+            segment.close()
+
+
+def replay_spool(spool_dir=SPOOL_DIR) -> int:
+    """Insert rows from segments no live process holds (left by a crash), returns rows replayed"""
+    if not os.path.isdir(spool_dir):
+        return 0
+    replayed = 0
+    for name in sorted(os.listdir(spool_dir)):
+        if not name.endswith('.jsonl'):
+            continue
+        path = os.path.join(spool_dir, name)
+        try:
+            f = open(path, 'r+', encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # still owned by a running worker
+            if not os.path.exists(path):
+                continue  # committed and removed while we waited for the lock
+            rows = []
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    pass  # torn last line from the crash
+            try:
+                replayed += insert_batch(rows) if rows else 0
+            except Exception as e:
+                print(f"Replaying {name} failed: {e}")
+                continue
+            os.remove(path)
+    return replayed
+
+
+_queue = None
+_queue_pid = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> WriteBehindQueue:
+    """Queue of this process, started on first use (and again after a fork)"""
+    global _queue, _queue_pid
+    with _queue_lock:
+        if _queue is None or _queue_pid != os.getpid():
+            _queue = WriteBehindQueue()
+            _queue_pid = os.getpid()
+        return _queue
+
+
+@atexit.register
+def _flush_at_exit():
+    if _queue is not None and _queue_pid == os.getpid():
+        _queue.close()
+
+
+def queue_message(name: str, email: str, subject: str, message: str) -> bool:
+    return get_queue().enqueue('contact_messages', (name, email, subject, message))
+
+
+def queue_subscriber(email: str) -> bool:
+    return get_queue().enqueue('newsletter_subscribers', (email,))
@@ -1,12 +1,35 @@
-import os, sys, random
+"""
+Inject SEO keywords into the metadata of every image under static/img.
+
+Metadata is written as EXIF and XMP directly into the JPEG/PNG/WebP
+container (see functions/image_metadata.py), so pixels are never re-encoded.
+Images whose size and mtime (or content hash) match the manifest from the
+previous run are skipped, so only new or changed files are processed. The
+manifest is kept under cache/ (one per folder), outside the public static tree.
+
+Usage:
+    python keyword-injector.py [folder] [--jobs N] [--dry-run] [--force] [--verify]
+"""
+import os, random, argparse, hashlib, json, time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from PIL import Image
 import piexif
 from datetime import datetime
+from functions.image_metadata import EXIF_HEADER, build_xmp, read_exif, write_metadata, pixel_digest
 
 
 SUPPORTED_FORMATS = [".jpg", ".jpeg", ".png", ".webp"]
 
+# Generated responsive derivatives (see functions/images.py) are left alone
+SKIP_DIRS = {"responsive"}
+
+MANIFEST_DIR = Path(__file__).resolve().parent / "cache" / "keyword-manifests"
+# Where earlier versions kept the manifest, inside the (publicly served) folder
+LEGACY_MANIFEST_FILE = ".keyword-manifest.json"
+
+# Seconds per MB used by --dry-run until a run has recorded real timings
+DEFAULT_SECONDS_PER_MB = {".jpg": 0.01, ".jpeg": 0.01, ".png": 0.01, ".webp": 0.01}
+
 
 def load_keywords(keywords_file):
     with open(keywords_file, "r", encoding="utf-8") as f:
@@ -28,14 +51,10 @@ def build_metadata_strings(keywords, filename):
     return title, description, keyword_string
 
 
-def inject_jpeg_metadata(img_path, keywords):
-    filename = img_path.stem
-    title, description, keyword_string = build_metadata_strings(keywords, filename)
-
-    img = Image.open(img_path)
-
+def build_exif(img_path, title, description, keyword_string):
+    """Existing EXIF of the image with the keyword tags set (TIFF bytes)"""
     try:
-        exif_dict = piexif.load(img.info.get("exif", b""))
+        exif_dict = piexif.load(read_exif(img_path) or b"")
     except Exception:
         exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
 
@@ -49,71 +68,178 @@ def inject_jpeg_metadata(img_path, keywords):
     now = datetime.now().strftime("%Y:%m:%d %H:%M:%S")
     exif_dict["0th"][piexif.ImageIFD.DateTime] = now.encode("utf-8")
 
-    exif_bytes = piexif.dump(exif_dict)
-    img.save(img_path, exif=exif_bytes)
+    return piexif.dump(exif_dict)[len(EXIF_HEADER):]
 
 
-def inject_png_metadata(img_path, keywords):
+def inject_metadata(img_path, keywords, verify=False):
+    """
+    Splice EXIF and XMP (plus PNG text chunks) into the file without re-encoding it.
+    With verify, the decoded pixels of the result are compared to the original
+    before it replaces the file.
+    """
     filename = img_path.stem
     title, description, keyword_string = build_metadata_strings(keywords, filename)
+    exif = build_exif(img_path, title, description, keyword_string)
+    xmp = build_xmp(title, description, keywords)
+    text = {"Title": title, "Description": description, "Keywords": keyword_string}
+
+    tmp = img_path.with_name(f".{img_path.name}.tmp")
+    try:
+        write_metadata(img_path, tmp, exif=exif, xmp=xmp, text=text)
+        if verify and pixel_digest(tmp) != pixel_digest(img_path):
+            raise ValueError("pixel data changed, original left untouched")
+        os.replace(tmp, img_path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
 
-    img = Image.open(img_path)
-    metadata = img.info
 
-    metadata["Title"] = title
-    metadata["Description"] = description
-    metadata["Keywords"] = keyword_string
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    img.save(img_path, pnginfo=None)
 
+def file_entry(path):
+    """Manifest record for a file as it is on disk now"""
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash(path)}
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def manifest_path_for(folder):
+    """cache/keyword-manifests/<folder name>-<hash of its absolute path>.json"""
+    digest = hashlib.blake2b(str(folder.resolve()).encode("utf-8"), digest_size=6).hexdigest()
+    return MANIFEST_DIR / f"{folder.resolve().name}-{digest}.json"
 
-def inject_webp_metadata(img_path, keywords):
-    filename = img_path.stem
-    title, description, keyword_string = build_metadata_strings(keywords, filename)
 
-    img = Image.open(img_path)
+def save_manifest(manifest_path, manifest):
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(f"{manifest_path}.tmp")
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, manifest_path)
 
-    img.save(
-        img_path,
-        format="WEBP",
-        quality=100,
-        method=6,
-    )
 
+def find_images(folder):
+    for img_path in sorted(folder.rglob("*")):
+        if img_path.suffix.lower() not in SUPPORTED_FORMATS:
+            continue
+        if SKIP_DIRS.intersection(img_path.relative_to(folder).parts[:-1]):
+            continue
+        yield img_path
+
+
+def is_unchanged(img_path, entry):
+    """Whether img_path still matches its manifest entry (hash only checked when size/mtime moved)"""
+    if not entry:
+        return False
+    stat = img_path.stat()
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime == entry["mtime"]:
+        return True
+    # Touched (e.g. by a checkout) but possibly identical
+    return file_hash(img_path) == entry["hash"]
+
+
+def process_image(img_path, keywords, verify=False):
+    """Inject keywords into one image, returns (seconds taken, error or None)"""
+    start = time.perf_counter()
+    try:
+        inject_metadata(img_path, keywords, verify)
+    except Exception as e:
+        return time.perf_counter() - start, str(e)
+    return time.perf_counter() - start, None
 
-def process_images(folder_path, keywords):
+
+def estimate_seconds(pending, manifest):
+    """Expected processing time from the per-format throughput of earlier runs"""
+    rates = {}
+    for suffix in DEFAULT_SECONDS_PER_MB:
+        timed = [e for path, e in manifest.items() if path.lower().endswith(suffix) and e.get("seconds")]
+        megabytes = sum(e["size"] for e in timed) / 1e6
+        rates[suffix] = (sum(e["seconds"] for e in timed) / megabytes) if megabytes else DEFAULT_SECONDS_PER_MB[suffix]
+    return sum(p.stat().st_size / 1e6 * rates[p.suffix.lower()] for p in pending)
+
+
+def process_images(folder_path, keywords, jobs=1, dry_run=False, force=False, verify=False):
     folder = Path(folder_path)
 
     if not folder.exists():
         print("Folder does not exist.")
         return
 
-    for img_path in folder.rglob("*"):
-        if img_path.suffix.lower() not in SUPPORTED_FORMATS:
-            continue
+    manifest_path = manifest_path_for(folder)
+    legacy_path = folder / LEGACY_MANIFEST_FILE
+    manifest = load_manifest(manifest_path) if manifest_path.exists() else load_manifest(legacy_path)
+    images = list(find_images(folder))
+    pending = [p for p in images if force or not is_unchanged(p, manifest.get(p.relative_to(folder).as_posix()))]
+
+    if dry_run:
+        by_format = {}
+        for img_path in pending:
+            count, size = by_format.get(img_path.suffix.lower(), (0, 0))
+            by_format[img_path.suffix.lower()] = (count + 1, size + img_path.stat().st_size)
+        print(f"{len(pending)} of {len(images)} image(s) would be processed:")
+        for suffix, (count, size) in sorted(by_format.items()):
+            print(f"  {suffix}: {count} file(s), {size / 1e6:.1f} MB")
+        seconds = estimate_seconds(pending, manifest)
+        print(f"Estimated time: {seconds:.1f}s with 1 job, {seconds / max(jobs, 1):.1f}s with {jobs}")
+        return
 
-        print(f"Processing: {img_path.name}")
-        
-        # Select 5 random keywords for this image
-        random_keywords = random.sample(keywords, min(5, len(keywords)))
+    # Select 5 random keywords for each image up front so workers stay independent
+    work = [(img_path, random.sample(keywords, min(5, len(keywords))), verify) for img_path in pending]
+    failed = 0
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(process_image, *zip(*work), chunksize=1) if work else []
+            results = list(zip((w[0] for w in work), results))
+    else:
+        results = ((w[0], process_image(*w)) for w in work)
+
+    for img_path, (seconds, error) in results:
+        rel = img_path.relative_to(folder).as_posix()
+        if error:
+            print(f"Failed: {img_path.name}: {error}")
+            failed += 1
+            manifest.pop(rel, None)
+            continue
+        print(f"Processed: {img_path.name} ({seconds:.2f}s)")
+        manifest[rel] = {**file_entry(img_path), "seconds": round(seconds, 3)}
 
-        if img_path.suffix.lower() in [".jpg", ".jpeg"]:
-            inject_jpeg_metadata(img_path, random_keywords)
-        elif img_path.suffix.lower() == ".png":
-            inject_png_metadata(img_path, random_keywords)
-        elif img_path.suffix.lower() == ".webp":
-            inject_webp_metadata(img_path, random_keywords)
+    # Forget files that were deleted or renamed
+    existing = {p.relative_to(folder).as_posix() for p in images}
+    manifest = {rel: entry for rel, entry in manifest.items() if rel in existing}
+    save_manifest(manifest_path, manifest)
+    if legacy_path.exists():
+        legacy_path.unlink()
 
-    print("Done.")
+    print(f"Done. {len(work) - failed} processed, {failed} failed, {len(images) - len(work)} unchanged.")
 
 
 def main():
-    folder_path = "static/img"
-    keywords_file = "keywords.txt"
-
-    keywords = load_keywords(keywords_file)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", nargs="?", default="static/img")
+    parser.add_argument("--keywords", default="keywords.txt", help="comma or newline separated keywords file")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="worker processes (default: 1)")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be processed and how long it would take")
+    parser.add_argument("--force", action="store_true", help="process every image, ignoring the manifest")
+    parser.add_argument("--verify", action="store_true", help="decode each result and keep the original unless its pixels are identical")
+    args = parser.parse_args()
+
+    keywords = load_keywords(args.keywords)
     random.shuffle(keywords)
-    process_images(folder_path, keywords)
+    process_images(args.folder, keywords, jobs=args.jobs, dry_run=args.dry_run, force=args.force, verify=args.verify)
 
 
 if __name__ == "__main__":
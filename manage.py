@@ -0,0 +1,213 @@
+"""
+Maintenance commands for the site database.
+
+Usage:
+    python manage.py init-db
+    python manage.py backfill-excerpts [--all]
+    python manage.py backfill-images [--all]
+    python manage.py image-worker [--threads N]
+    python manage.py reindex-search
+    python manage.py related-posts [--count N]
+    python manage.py turnstile-standin [--port 8787] [--delay S] [--status CODE]
+    python manage.py shift-created-at --hours H --until-id N
+    python manage.py profile-report [--collapsed] [--endpoint NAME] [--since MINUTES] [--limit N]
+"""
+import argparse, json, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from PIL import Image
+from functions.database import init_db, shift_created_at, rebuild_search_index, backfill_post_text_fields, save_image_variants, save_image_placeholder, get_image_paths
+from functions.post_store import bump_posts_version
+from functions.profiling import PROFILE_DIR, profile_files, merge_collapsed, top_from_stacks, top_from_pstats
+from functions.related_posts import RELATED_POSTS_COUNT, rebuild_related_posts
+from functions.images import STATIC_IMG_DIR, library_images, source_url, flatten_to_rgb, generate_derivatives, placeholder
+
+
+def cmd_init_db(args):
+    init_db()
+    print("Database schema is up to date.")
+
+
+def cmd_backfill_excerpts(args):
+    updated = backfill_post_text_fields(only_missing=not args.all)
+    if updated:
+        # Running workers reload their post snapshot and cached pages
+        bump_posts_version()
+    print(f"Updated excerpt/meta description/reading time for {updated} post(s).")
+
+
+def cmd_backfill_images(args):
+    init_db()
+    # path -> whether its placeholder exists too
+    done = {} if args.all else get_image_paths()
+    generated = failed = 0
+    for rel_path in library_images():
+        path = source_url(rel_path)
+        if done.get(path):
+            continue
+        try:
+            with Image.open(os.path.join(STATIC_IMG_DIR, rel_path)) as img:
+                if path in done:
+                    # Derivatives exist, only the placeholder is missing
+                    save_image_placeholder(path, *placeholder(flatten_to_rgb(img)))
+                    generated += 1
+                    print(f"Placeholder: {rel_path}")
+                    continue
+                record = generate_derivatives(flatten_to_rgb(img), rel_path)
+        except Exception as e:
+            print(f"Skipping {rel_path}: {e}")
+            failed += 1
+            continue
+        save_image_variants(path, record)
+        generated += 1
+        print(f"Generated: {rel_path} ({record['width']}x{record['height']})")
+    if generated:
+        # Running workers reload their post snapshot (and its srcsets) and cached pages
+        bump_posts_version()
+    print(f"Generated derivatives/placeholders for {generated} image(s), {failed} failed.")
+
+
+def cmd_image_worker(args):
+    # Importing the app registers its publish hooks (page cache and sitemap
+    # invalidation); its own worker threads stay off, only --threads run
+    os.environ['IMAGE_WORKER_THREADS'] = '0'
+    import app  # noqa: F401
+    from functions.image_jobs import start_workers
+    workers = start_workers(args.threads)
+    print(f"Processing image jobs with {len(workers)} thread(s), Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_reindex_search(args):
+    init_db()
+    indexed = rebuild_search_index()
+    # Running workers drop their cached search results
+    bump_posts_version()
+    print(f"Indexed {indexed} post(s) for search.")
+
+
+def cmd_related_posts(args):
+    init_db()
+    stored = rebuild_related_posts(args.count)
+    # Cached post pages pick up the new neighbours
+    bump_posts_version()
+    print(f"Stored {stored} related post link(s).")
+
+
+def cmd_shift_created_at(args):
+    from functions.site_config import sitemap_args
+    from functions.sitemap import build_all
+    shifted = shift_created_at(args.hours, args.until_id)
+    # Cached pages (Last-Modified) and the sitemap's lastmod follow the new times
+    bump_posts_version()
+    build_all(*sitemap_args())
+    print(f"Shifted created_at of {shifted} post(s) by {args.hours:+g} hours.")
+
+
+def cmd_turnstile_standin(args):
+    used = set()
+    used_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            time.sleep(args.delay)
+            token = form.get('response', [''])[0]
+            # Same tokens as Cloudflare's test keys: anything but "fail" passes, once
+            with used_lock:
+                duplicate = token in used
+                used.add(token)
+            if token == 'fail':
+                errors = ['invalid-input-response']
+            else:
+                errors = ['timeout-or-duplicate'] if duplicate else []
+            body = json.dumps({'success': not errors, 'error-codes': errors}).encode()
+            self.send_response(args.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print(f"Stand-in verifier on http://127.0.0.1:{args.port}/ (run the app with TURNSTILE_VERIFY_URL set to it), Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_profile_report(args):
+    since = time.time() - args.since * 60 if args.since else None
+    paths = profile_files(args.dir, args.endpoint, since)
+    stacks = merge_collapsed(paths)
+    prof_paths = [path for path in paths if path.endswith('.prof')]
+    if args.collapsed:
+        if not stacks:
+            sys.exit(f"No sampled (.folded) profiles in {args.dir}; collect them with PROFILE_MODE=sample.")
+        # flamegraph.pl / speedscope input: "frame;frame;frame count"
+        for stack, count in stacks.most_common():
+            print(f"{stack} {count}")
+        return
+    if not paths:
+        sys.exit(f"No profiles in {args.dir}.")
+    if prof_paths:
+        print(f"cProfile: {len(prof_paths)} request(s)")
+        top_from_pstats(prof_paths, args.sort, args.limit, sys.stdout)
+    if stacks:
+        print(f"Sampled: {len(paths) - len(prof_paths)} request(s)")
+        print(top_from_stacks(stacks, args.limit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('init-db', help='add any missing columns/tables').set_defaults(func=cmd_init_db)
+
+    backfill = commands.add_parser('backfill-excerpts', help='precompute post excerpts and SEO metadata')
+    backfill.add_argument('--all', action='store_true', help='recompute every post, not only missing ones')
+    backfill.set_defaults(func=cmd_backfill_excerpts)
+
+    images = commands.add_parser('backfill-images', help='generate responsive derivatives and placeholders for static/img')
+    images.add_argument('--all', action='store_true', help='regenerate images that already have derivatives')
+    images.set_defaults(func=cmd_backfill_images)
+
+    worker = commands.add_parser('image-worker', help='process queued post images (run with IMAGE_WORKER_THREADS=0 in the app)')
+    worker.add_argument('--threads', type=int, default=2, help='worker threads (default: 2)')
+    worker.set_defaults(func=cmd_image_worker)
+
+    commands.add_parser('reindex-search', help='rebuild the full-text search index').set_defaults(func=cmd_reindex_search)
+
+    related = commands.add_parser('related-posts', help='recompute the related articles shown on post pages')
+    related.add_argument('--count', type=int, default=RELATED_POSTS_COUNT, help=f'related posts kept per post (default: {RELATED_POSTS_COUNT})')
+    related.set_defaults(func=cmd_related_posts)
+
+    shift = commands.add_parser('shift-created-at', help='convert created_at of older posts from local time to UTC (run once)')
+    shift.add_argument('--hours', type=float, required=True, help="hours to add, e.g. -3 for posts written at UTC+3")
+    shift.add_argument('--until-id', type=int, required=True, help='last post id written in local time')
+    shift.set_defaults(func=cmd_shift_created_at)
+
+    standin = commands.add_parser('turnstile-standin', help='local siteverify stand-in for testing the contact form')
+    standin.add_argument('--port', type=int, default=8787, help='port to listen on (default: 8787)')
+    standin.add_argument('--delay', type=float, default=0.0, help='seconds to wait before answering (default: 0)')
+    standin.add_argument('--status', type=int, default=200, help='HTTP status to answer with, e.g. 503 (default: 200)')
+    standin.set_defaults(func=cmd_turnstile_standin)
+
+    report = commands.add_parser('profile-report', help='merge request profiles into a top-functions report or collapsed stacks')
+    report.add_argument('--collapsed', action='store_true', help='print collapsed stacks for flamegraph.pl instead (sampled profiles)')
+    report.add_argument('--endpoint', help='only profiles of this endpoint, e.g. post or index')
+    report.add_argument('--since', type=float, help='only profiles from the last MINUTES')
+    report.add_argument('--limit', type=int, default=30, help='functions listed (default: 30)')
+    report.add_argument('--sort', default='cumulative', help='pstats sort key for cProfile profiles (default: cumulative)')
+    report.add_argument('--dir', default=PROFILE_DIR, help=f'profile directory (default: {PROFILE_DIR})')
+    report.set_defaults(func=cmd_profile_report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
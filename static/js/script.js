@@ -57,13 +57,18 @@ document.addEventListener('DOMContentLoaded', function() {
                 },
                 body: JSON.stringify({ email: email })
             })
-            .then(response => response.json())
+            .then(response => response.json().then(data => {
+                if (!response.ok) {
+                    throw new Error(data.message);
+                }
+                return data;
+            }))
             .then(data => {
                 Swal.fire({
                     toast: true,
                     position: 'top-end',
-                    icon: 'success',
-                    title: 'Subscribed successfully!',
+                    icon: data.already_subscribed ? 'info' : 'success',
+                    title: data.already_subscribed ? 'You are already subscribed' : 'Subscribed successfully!',
                     showConfirmButton: false,
                     timer: 3000,
                     timerProgressBar: true
@@ -1,64 +1,117 @@
-import sys
+"""
+Inspect image metadata under static/img (or a given file/folder).
+
+Only container headers and metadata chunks are parsed (JPEG APPn, PNG chunks,
+WebP RIFF), never pixel data, so the whole library scans in well under a
+second on a thread pool.
+
+Usage:
+    python view_metadata.py [path] [--format text|jsonl|csv] [--jobs N]
+    python view_metadata.py --summary [--max-kb 500] [--max-width 2000] [--strict]
+"""
+import sys, argparse, csv, json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
-import piexif
+from functions.image_metadata import scan_image
 
 SUPPORTED_FORMATS = [".jpg", ".jpeg", ".png", ".webp"]
 
+# Generated responsive derivatives (see functions/images.py) aren't audited
+SKIP_DIRS = {"responsive"}
+
+FIELDS = ["path", "format", "width", "height", "bytes", "title", "description",
+          "keywords", "datetime", "has_exif", "has_xmp", "error"]
+
+
+def find_images(path: Path):
+    if path.is_file():
+        return [path]
+    return [
+        img for img in sorted(path.rglob("*"))
+        if img.suffix.lower() in SUPPORTED_FORMATS and not SKIP_DIRS.intersection(img.relative_to(path).parts[:-1])
+    ]
+
+
+def print_text(result):
+    print(f"\nInspecting '{result['path']}'")
+    if result["error"]:
+        print(f"  (failed to read) {result['error']}")
+        return
+    print(f"  {result['format']} {result['width']}x{result['height']}, {result['bytes'] / 1024:.0f} KB")
+    for field in ("title", "description", "keywords", "datetime"):
+        if result[field]:
+            print(f"  {field}: {result[field]}")
+    if not (result["has_exif"] or result["has_xmp"]):
+        print("  (no exif/xmp metadata)")
+
+
+def flag_result(result, max_bytes, max_width):
+    """Reasons an asset needs attention (empty when it is fine)"""
+    flags = []
+    if result["error"]:
+        flags.append(f"unreadable: {result['error']}")
+        return flags
+    if result["format"] != "webp":
+        flags.append(f"not webp ({result['format']})")
+    if result["bytes"] > max_bytes:
+        flags.append(f"{result['bytes'] / 1024:.0f} KB > {max_bytes / 1024:.0f} KB")
+    if result["width"] and result["width"] > max_width:
+        flags.append(f"{result['width']}px wide > {max_width}px")
+    return flags
 
-def show_exif(exif_dict):
-    # iterate through 0th IFD for our injected tags
-    ifd = exif_dict.get("0th", {})
-    for tag, value in ifd.items():
-        name = piexif.TAGS["0th"].get(tag, {}).get("name", tag)
-        # decode bytes if necessary
-        if isinstance(value, bytes):
-            try:
-                # some values are utf-16le
-                value = value.decode("utf-8")
-            except Exception:
-                try:
-                    value = value.decode("utf-16le")
-                except Exception:
-                    pass
-        print(f"  {name}: {value}")
-
-
-def inspect_image(img_path: Path):
-    print(f"\nInspecting '{img_path}'")
-    img = Image.open(img_path)
-    suffix = img_path.suffix.lower()
-    if suffix in [".jpg", ".jpeg"]:
-        try:
-            exif_dict = piexif.load(img.info.get("exif", b""))
-            show_exif(exif_dict)
-        except Exception as e:
-            print("  (no exif or failed to read)", e)
-    elif suffix == ".png":
-        info = img.info
-        for k, v in info.items():
-            print(f"  {k}: {v}")
-    elif suffix == ".webp":
-        # PIL does not expose metadata much for webp
-        print("  (WEBP metadata not supported)")
-    else:
-        print("  unsupported format")
+
+def print_summary(results, max_bytes, max_width):
+    """Totals per format plus every flagged asset, returns the number flagged"""
+    formats = {}
+    for result in results:
+        count, size = formats.get(result["format"], (0, 0))
+        formats[result["format"]] = (count + 1, size + result["bytes"])
+
+    print(f"{len(results)} image(s), {sum(r['bytes'] for r in results) / 1e6:.1f} MB")
+    for fmt, (count, size) in sorted(formats.items(), key=lambda item: -item[1][1]):
+        print(f"  {fmt}: {count} file(s), {size / 1e6:.1f} MB")
+
+    flagged = [(r, flag_result(r, max_bytes, max_width)) for r in results]
+    flagged = [(r, flags) for r, flags in flagged if flags]
+    print(f"\n{len(flagged)} flagged:")
+    for result, flags in sorted(flagged, key=lambda item: -item[0]["bytes"]):
+        print(f"  {result['path']}: {'; '.join(flags)}")
+    return len(flagged)
 
 
 def main():
-    if len(sys.argv) > 1:
-        path = Path(sys.argv[1])
-    else:
-        path = Path("static/img")
-
-    if path.is_dir():
-        for img in path.rglob("*"):
-            if img.suffix.lower() in SUPPORTED_FORMATS:
-                inspect_image(img)
-    elif path.is_file():
-        inspect_image(path)
-    else:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default="static/img")
+    parser.add_argument("--format", choices=["text", "jsonl", "csv"], default="text", help="output format (default: text)")
+    parser.add_argument("--jobs", "-j", type=int, default=8, help="scanner threads (default: 8)")
+    parser.add_argument("--summary", action="store_true", help="totals per format and oversized/non-WebP assets")
+    parser.add_argument("--max-kb", type=int, default=500, help="size above which --summary flags an asset (default: 500)")
+    parser.add_argument("--max-width", type=int, default=2000, help="width above which --summary flags an asset (default: 2000)")
+    parser.add_argument("--strict", action="store_true", help="with --summary, exit with status 1 if anything is flagged")
+    args = parser.parse_args()
+
+    path = Path(args.path)
+    if not path.exists():
         print(f"Path {path} does not exist")
+        sys.exit(1)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        results = list(pool.map(scan_image, find_images(path)))
+
+    if args.summary:
+        flagged = print_summary(results, args.max_kb * 1024, args.max_width)
+        sys.exit(1 if args.strict and flagged else 0)
+
+    if args.format == "jsonl":
+        for result in results:
+            print(json.dumps(result, ensure_ascii=False))
+    elif args.format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    else:
+        for result in results:
+            print_text(result)
 
 
 if __name__ == "__main__":